@@ -0,0 +1,129 @@
+# ann_index.py
+from __future__ import annotations
+
+from typing import List, Sequence
+
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+from embedding_matrix import EmbeddingMatrix
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest-neighbour index (pure NumPy).
+    Rows are bucketed under k-means centroids; a search scores the centroids
+    and then only the rows in the `nprobe` closest buckets.
+    Vectors are read from the EmbeddingMatrix, so nothing is duplicated.
+    Below `train_min` rows search is exact. Training happens once, at
+    `train_min` rows; later rows join their nearest existing centroid until
+    rebuild() retrains on the grown matrix (see `stale`). K-means cost is
+    bounded by `max_nlist` centroids and a `max_train`-row sample.
+    """
+    def __init__(
+        self,
+        matrix: EmbeddingMatrix,
+        nprobe: int = 8,
+        train_min: int = 2048,
+        kmeans_iters: int = 8,
+        seed: int = 0,
+        max_nlist: int = 256,
+        max_train: int = 8192,
+    ):
+        if np is None:
+            raise RuntimeError("IVFIndex requires numpy.")
+        self.matrix = matrix
+        self.nprobe = max(1, nprobe)
+        self.train_min = max(1, train_min)
+        self.kmeans_iters = kmeans_iters
+        self.max_nlist = max(1, max_nlist)
+        self.max_train = max(1, max_train)
+        self._rng = np.random.default_rng(seed)
+        self._centroids = None               # np.ndarray (nlist, dim)
+        self._lists: List[List[int]] = []
+        self._trained_n = 0
+        self._n = 0
+
+    def __len__(self) -> int:
+        return self._n
+
+    @property
+    def trained(self) -> bool:
+        return self._centroids is not None
+
+    @property
+    def stale(self) -> bool:
+        """True once the index has doubled since training; rebuild() rebalances it."""
+        return self.trained and self._n >= 2 * self._trained_n
+
+    def add(self, row: int, vec: Sequence[float]) -> None:
+        """Registers matrix row `row` under its nearest centroid (trains once at `train_min`)."""
+        self._n = max(self._n, row + 1)
+        if self._centroids is None:
+            if self._n >= self.train_min:
+                self._train()
+        else:
+            q = np.asarray(vec, dtype=np.float32)
+            self._lists[int(np.argmax(self._centroids @ q))].append(row)
+
+    def rebuild(self) -> None:
+        """Retrains the centroids on the current rows and reassigns them all."""
+        if self._n:
+            self._train()
+
+    def sync(self, n: int) -> None:
+        """Indexes matrix rows [0, n) in one pass, e.g. after reopening a store."""
+        self._n = n
+        if n >= self.train_min:
+            self._train()
+
+    def search(self, query: Sequence[float], k: int) -> List[int]:
+        """Approximate top-k rows by dot product, best first."""
+        if self._n == 0 or k <= 0:
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        if self._centroids is None:
+            rows = np.arange(self._n)
+        else:
+            probe = np.argsort(-(self._centroids @ q))[: self.nprobe]
+            picked = [self._lists[c] for c in probe.tolist() if self._lists[c]]
+            if not picked:
+                return []
+            rows = np.fromiter((r for lst in picked for r in lst), dtype=np.int64)
+        sims = self.matrix.scores_for(rows, q)
+        if len(rows) > k:
+            top = np.argpartition(-sims, k - 1)[:k]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.argsort(-sims[top])]
+        return rows[top].tolist()
+
+    # ---- Internals ----
+
+    def _train(self) -> None:
+        nlist = min(self.max_nlist, max(1, int(4 * np.sqrt(self._n))))
+        sample_n = min(self._n, self.max_train, 64 * nlist)
+        sample = self.matrix.rows(self._rng.choice(self._n, size=sample_n, replace=False))
+        cents = sample[self._rng.choice(sample_n, size=min(nlist, sample_n), replace=False)].copy()
+
+        # Spherical k-means on a sample
+        for _ in range(self.kmeans_iters):
+            assign = np.argmax(sample @ cents.T, axis=1)
+            sums = np.zeros_like(cents)
+            np.add.at(sums, assign, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            keep = norms[:, 0] > 0
+            cents[keep] = sums[keep] / norms[keep]
+
+        # Assign every row in chunks to bound the temporary (n, nlist) matrix
+        lists: List[List[int]] = [[] for _ in range(len(cents))]
+        for start in range(0, self._n, 8192):
+            block = self.matrix.rows(slice(start, min(self._n, start + 8192)))
+            assign = np.argmax(block @ cents.T, axis=1)
+            for off, c in enumerate(assign.tolist()):
+                lists[c].append(start + off)
+
+        self._centroids = cents
+        self._lists = lists
+        self._trained_n = self._n
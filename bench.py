@@ -0,0 +1,263 @@
+# bench.py
+from __future__ import annotations
+
+import argparse
+import random
+import shutil
+import tempfile
+import time
+from typing import List
+
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+from token_counter import TokenCounter
+from embedding import Embedder, HashingEmbedder
+from focus import FocusManager, FocusConfig
+from utils import l2_normalize_inplace
+
+class PoolEmbedder(Embedder):
+    """
+    Cycles through a fixed pool of random unit vectors.
+    Keeps Python-side memory bounded for 100k-item sessions.
+    """
+    def __init__(self, dim: int = 1536, pool_size: int = 1024, seed: int = 0, topics: int = 0):
+        self.dim = dim
+        rng = random.Random(seed)
+        # Optional topic structure: each vector = topic center + noise
+        centers = [[rng.gauss(0.0, 1.0) for _ in range(dim)] for _ in range(topics)]
+        self._pool: List[List[float]] = []
+        for i in range(pool_size):
+            v = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+            if centers:
+                c = centers[i % topics]
+                v = [2.0 * cx + x for cx, x in zip(c, v)]
+            l2_normalize_inplace(v)
+            self._pool.append(v)
+        self._i = 0
+
+    def encode(self, text: str) -> List[float]:
+        v = self._pool[self._i % len(self._pool)]
+        self._i += 1
+        return v
+
+def _timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def bench_scoring(sizes: List[int], dim: int, repeat: int) -> None:
+    print(f"=== build_context scoring (dim={dim}) ===")
+    print(f"{'items':>8s} | {'python ms':>10s} | {'numpy ms':>10s} | {'speedup':>8s}")
+    tc = TokenCounter("gpt-4o-mini")
+    emb = PoolEmbedder(dim=dim)
+    for n in sizes:
+        fm = FocusManager(embedder=emb, token_counter=tc, config=FocusConfig())
+        for i in range(n):
+            fm.add_message("user" if i % 2 == 0 else "assistant", f"message {i}")
+        q = emb.encode("query")
+
+        py_s = _timeit(lambda: fm._plan_fidelity(fm._score_python(q)), 1)
+        np_s = _timeit(lambda: fm._plan_fidelity(fm._score_vectorized(q)), repeat)
+        print(f"{n:8d} | {py_s * 1e3:10.1f} | {np_s * 1e3:10.2f} | {py_s / np_s:7.1f}x")
+
+def bench_ann(sizes: List[int], dim: int, repeat: int, top_k: int = 64) -> None:
+    print(f"\n=== ANN candidate scoring vs exact (dim={dim}, top_k={top_k}) ===")
+    print(f"{'items':>8s} | {'exact ms':>9s} | {'ann ms':>8s} | {'scored':>7s} | {'recall@k':>8s}")
+    tc = TokenCounter("gpt-4o-mini")
+    for n in sizes:
+        emb = PoolEmbedder(dim=dim, pool_size=4096, topics=64)
+        cfg = FocusConfig(use_ann_index=True, ann_top_k=top_k)
+        fm = FocusManager(embedder=emb, token_counter=tc, config=cfg)
+        for i in range(n):
+            fm.add_message("user", f"message {i}")
+        fm.rebuild_index()
+        q = emb.encode("query")
+
+        exact = fm._score_vectorized(q)
+        approx, scored = fm._score_candidates(q)
+        exact_top = set(np.argsort(-exact)[:top_k].tolist())
+        approx_top = set(np.argsort(-approx)[:top_k].tolist())
+        recall = len(exact_top & approx_top) / max(1, len(exact_top))
+
+        ex_s = _timeit(lambda: fm._score_vectorized(q), repeat)
+        ann_s = _timeit(lambda: fm._score_candidates(q), repeat)
+        print(f"{n:8d} | {ex_s * 1e3:9.2f} | {ann_s * 1e3:8.2f} | {scored:7d} | {recall:8.3f}")
+
+def bench_ingest(sizes: List[int], dim: int) -> None:
+    print(f"\n=== Ingestion: add_message loop vs add_messages (HashingEmbedder dim={dim}) ===")
+    print(f"{'items':>8s} | {'loop msg/s':>11s} | {'bulk msg/s':>11s}")
+    tc = TokenCounter("gpt-4o-mini")
+    for n in sizes:
+        msgs = [("user", f"message {i} about topic {i % 97} and some filler words") for i in range(n)]
+        fm = FocusManager(embedder=HashingEmbedder(dim=dim), token_counter=tc)
+        t0 = time.perf_counter()
+        for role, content in msgs:
+            fm.add_message(role, content)
+        loop_rate = n / (time.perf_counter() - t0)
+        fm = FocusManager(embedder=HashingEmbedder(dim=dim), token_counter=tc)
+        stats = fm.add_messages(iter(msgs))
+        print(f"{n:8d} | {loop_rate:11.0f} | {stats['messages_per_s']:11.0f}")
+
+def bench_persist(sizes: List[int], dim: int) -> None:
+    from item_store import MmapItemStore
+
+    print(f"\n=== MmapItemStore reopen (HashingEmbedder dim={dim}) ===")
+    print(f"{'items':>8s} | {'ingest s':>9s} | {'reopen ms':>10s} | {'first build ms':>14s}")
+    tc = TokenCounter("gpt-4o-mini")
+    for n in sizes:
+        path = tempfile.mkdtemp(prefix="afm-bench-")
+        try:
+            store = MmapItemStore(path)
+            fm = FocusManager(embedder=HashingEmbedder(dim=dim), token_counter=tc, store=store)
+            stats = fm.add_messages((("user", f"message {i} about topic {i % 97}") for i in range(n)), chunk_size=4096)
+            store.close()
+
+            t0 = time.perf_counter()
+            store = MmapItemStore(path)
+            reopen = time.perf_counter() - t0
+            fm = FocusManager(embedder=HashingEmbedder(dim=dim), token_counter=tc, store=store)
+            t0 = time.perf_counter()
+            fm.build_context("topic 5", budget_tokens=400)
+            build = time.perf_counter() - t0
+            store.close()
+            print(f"{n:8d} | {stats['seconds']:9.2f} | {reopen * 1e3:10.2f} | {build * 1e3:14.1f}")
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+def bench_hashing(sizes: List[int], dim: int, repeat: int) -> None:
+    print(f"\n=== HashingEmbedder builtin vs stable (dim={dim}, 2k-word messages) ===")
+    print(f"{'msgs':>8s} | {'builtin ms':>10s} | {'stable ms':>10s} | {'stable batch ms':>15s}")
+    rng = random.Random(0)
+    vocab = [f"w{i}" for i in range(5000)]
+    for n in sizes:
+        texts = [" ".join(rng.choice(vocab) for _ in range(2000)) for _ in range(n)]
+        builtin = HashingEmbedder(dim=dim)
+        stable = HashingEmbedder(dim=dim, stable=True)
+        stable.encode_many(texts)  # warm the token memo
+        b_s = _timeit(lambda: [builtin.encode(t) for t in texts], repeat)
+        s_s = _timeit(lambda: [stable.encode(t) for t in texts], repeat)
+        m_s = _timeit(lambda: stable.encode_many(texts), repeat)
+        print(f"{n:8d} | {b_s * 1e3:10.1f} | {s_s * 1e3:10.1f} | {m_s * 1e3:15.1f}")
+
+def bench_sparse(sizes: List[int], dim: int, repeat: int) -> None:
+    import sys
+
+    print(f"\n=== HashingEmbedder dense vs sparse scoring (dim={dim}, ~10-word messages) ===")
+    print(f"{'items':>8s} | {'dense B/item':>12s} | {'sparse B/item':>13s} | {'dense ms':>9s} | {'sparse ms':>9s}")
+    tc = TokenCounter("gpt-4o-mini")
+    for n in sizes:
+        msgs = [("user", f"message {i} about topic {i % 97} and some filler words") for i in range(n)]
+        row = []
+        for sparse in (False, True):
+            fm = FocusManager(embedder=HashingEmbedder(dim=dim, stable=True, sparse=sparse), token_counter=tc)
+            fm.add_messages(msgs, chunk_size=4096)
+            emb = fm.items()[0].embedding
+            size = (sys.getsizeof(emb) + sys.getsizeof(emb.indices) + sys.getsizeof(emb.values)
+                    if sparse else sys.getsizeof(emb) + 24 * len(emb))
+            q = fm.embedder.encode("topic 5 filler")
+            row += [size, _timeit(lambda: fm._score_vectorized(q), repeat)]
+        print(f"{n:8d} | {row[0]:12d} | {row[2]:13d} | {row[1] * 1e3:9.2f} | {row[3] * 1e3:9.2f}")
+
+def bench_quant(sizes: List[int], dim: int, repeat: int, top_k: int = 64) -> None:
+    print(f"\n=== Quantized embedding storage vs float32 (dim={dim}) ===")
+    print(f"{'items':>8s} | {'dtype':>7s} | {'B/item':>7s} | {'vs list':>7s} | {'max err':>8s} | "
+          f"{'mean err':>8s} | {'recall@k':>8s} | {'score ms':>8s}")
+    tc = TokenCounter("gpt-4o-mini")
+    list_bytes = 56 + 8 * dim + 24 * dim  # Python list of distinct floats
+    for n in sizes:
+        ref = None
+        for dtype in ("float32", "float16", "int8"):
+            emb = PoolEmbedder(dim=dim, pool_size=2048, topics=32)
+            fm = FocusManager(embedder=emb, token_counter=tc, config=FocusConfig(embedding_dtype=dtype))
+            fm.add_messages((("user", f"message {i}") for i in range(n)), chunk_size=4096)
+            q = emb.encode("query")
+            sims = fm._matrix.scores(q)
+            if ref is None:
+                ref = sims
+            err = np.abs(sims - ref)
+            recall = len(set(np.argsort(-ref)[:top_k].tolist()) & set(np.argsort(-sims)[:top_k].tolist())) / top_k
+            per_item = fm._matrix.nbytes / n
+            t = _timeit(lambda: fm._matrix.scores(q), repeat)
+            print(f"{n:8d} | {dtype:>7s} | {per_item:7.0f} | {list_bytes / per_item:6.1f}x | {err.max():8.5f} | "
+                  f"{err.mean():8.5f} | {recall:8.3f} | {t * 1e3:8.2f}")
+
+def bench_coarse(sizes: List[int], dim: int, repeat: int) -> None:
+    print(f"\n=== Coarse-to-fine scoring (dim={dim}, thresholds 0.5/0.3) ===")
+    print(f"{'items':>8s} | {'coarse':>6s} | {'score ms':>8s} | {'plan changes':>12s}")
+    tc = TokenCounter("gpt-4o-mini")
+    emb = PoolEmbedder(dim=dim, pool_size=2048, topics=16)
+    q = emb._pool[3]
+    for n in sizes:
+        ref = None
+        for coarse in (0, *(c for c in (512, 256, 128, 64) if c < dim)):
+            emb._i = 0
+            cfg = FocusConfig(high_threshold=0.5, mid_threshold=0.3, recency_half_life=n, coarse_dims=coarse)
+            fm = FocusManager(embedder=emb, token_counter=tc, config=cfg)
+            fm.add_messages((("user", f"message {i}") for i in range(n)), chunk_size=4096)
+            plan = fm._plan_fidelity(fm._score_vectorized(q))
+            ref = ref or plan
+            t = _timeit(lambda: fm._score_vectorized(q), repeat)
+            changes = sum(a != b for a, b in zip(ref, plan))
+            print(f"{n:8d} | {coarse or dim:6d} | {t * 1e3:8.2f} | {changes:12d}")
+
+def bench_tokens(sizes: List[int], repeat: int) -> None:
+    backend = TokenCounter("gpt-4o-mini").backend
+    print(f"\n=== TokenCounter memoization on repeated build_context ({backend}) ===")
+    print(f"{'items':>8s} | {'uncached ms':>11s} | {'cached ms':>9s} | {'speedup':>8s} | {'hit rate':>8s}")
+    rng = random.Random(0)
+    words = [f"w{i}" for i in range(2000)]
+    for n in sizes:
+        texts = [" ".join(rng.choice(words) for _ in range(rng.randint(20, 200))) for _ in range(n)]
+        row = []
+        for cache_size in (0, 16384):
+            tc = TokenCounter("gpt-4o-mini", cache_size=cache_size)
+            fm = FocusManager(embedder=HashingEmbedder(dim=256, stable=True), token_counter=tc,
+                              config=FocusConfig(high_threshold=0.2, mid_threshold=0.1))
+            fm.add_messages(("user", t) for t in texts)
+            turn = lambda: fm.build_context(texts[-1], 2000, system_preamble="You are a helpful assistant.")
+            turn()
+            row.append(_timeit(turn, repeat))
+        print(f"{n:8d} | {row[0] * 1e3:11.2f} | {row[1] * 1e3:9.2f} | {row[0] / row[1]:7.1f}x"
+              f" | {tc.stats()['hit_rate']:8.2f}")
+
+_BENCHES = ("scoring", "ann", "ingest", "persist", "hashing", "sparse", "quant", "coarse", "tokens")
+
+def main():
+    ap = argparse.ArgumentParser(description="AFM micro-benchmarks")
+    # Checked after parsing: argparse validates an empty `nargs="*"` list against `choices`
+    ap.add_argument("which", nargs="*", help=f"benchmarks to run (default: scoring); one of {', '.join(_BENCHES)}")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    ap.add_argument("--dim", type=int, default=1536)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+    args.which = args.which or ["scoring"]
+    unknown = [w for w in args.which if w not in _BENCHES]
+    if unknown:
+        ap.error(f"invalid choice: {', '.join(unknown)} (choose from {', '.join(_BENCHES)})")
+    if "scoring" in args.which:
+        bench_scoring(args.sizes, args.dim, args.repeat)
+    if "ann" in args.which:
+        bench_ann(args.sizes, args.dim, args.repeat)
+    if "ingest" in args.which:
+        bench_ingest(args.sizes, args.dim)
+    if "persist" in args.which:
+        bench_persist(args.sizes, args.dim)
+    if "hashing" in args.which:
+        bench_hashing(args.sizes, args.dim, args.repeat)
+    if "sparse" in args.which:
+        bench_sparse(args.sizes, args.dim, args.repeat)
+    if "quant" in args.which:
+        bench_quant(args.sizes, args.dim, args.repeat)
+    if "coarse" in args.which:
+        bench_coarse(args.sizes, args.dim, args.repeat)
+    if "tokens" in args.which:
+        bench_tokens(args.sizes, args.repeat)
+
+if __name__ == "__main__":
+    main()
@@ -122,6 +122,7 @@ def main():
         recency_half_life=10,
         max_placeholder_tokens=12,
         default_compress_ratio=0.35,
+        embed_workers=2,  # embed replies in the background while the user types
     )
 
     fm = FocusManager(embedder=emb, token_counter=tc, compressor=compressor, config=cfg)
@@ -131,16 +132,19 @@ def main():
     print("Type 'exit' to finish and see final packed context & memory summary.\n")
 
     last_meaningful_query = None
+    last_meaningful_item = None
 
     while True:
         user_in = input("You: ").strip()
         if user_in.lower() in END_WORDS:
             break
 
-        fm.add_message("user", user_in)
+        item = fm.add_message("user", user_in)
         if is_meaningful_query(user_in):
             last_meaningful_query = user_in
+            last_meaningful_item = item
 
+        # Same text as the message just added: its embedding is reused
         ctx, stats = fm.build_context(
             current_query=user_in,
             budget_tokens=800,
@@ -181,6 +185,7 @@ def main():
         current_query=last_meaningful_query,
         budget_tokens=800,
         system_preamble=system_preamble,
+        query_item_id=last_meaningful_item.id if last_meaningful_item else None,
     )
 
     print(f"\n--- Final packed context for query: \"{last_meaningful_query}\" ---")
@@ -196,6 +201,7 @@ def main():
     print("\n--- Memory summary ---")
     for it in fm.items():
         print(f"[{it.id:02d}] {it.role:9s} | {it.compression_state:11s} | {it.content[:80]}{'...' if len(it.content)>80 else ''}")
+    fm.close()
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,22 @@
 # compression.py
 from __future__ import annotations
 
-from typing import List, Optional, Tuple
+import asyncio
+import heapq
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+from compression_cache import content_hash
 from token_counter import TokenCounter
-from utils import split_sentences, truncate_to_tokens, simple_tokenize
+from utils import split_sentences, simple_tokenize
 
 class Compressor:
     """Interface for compressing long text to fit a target token budget."""
@@ -13,41 +26,211 @@ class Compressor:
     def compress(self, text: str, target_tokens: int, hint: Optional[str] = None) -> str:  # pragma: no cover
         raise NotImplementedError
 
+    async def acompress(self, text: str, target_tokens: int, hint: Optional[str] = None) -> str:
+        """Async compress; the default runs `compress` in a worker thread."""
+        return await asyncio.to_thread(self.compress, text, target_tokens, hint)
+
+    def prepare(self, text: str, sentence_counts: Optional[Sequence[int]] = None) -> None:
+        """
+        Optional hook called when a message is ingested, ahead of any
+        compress(text, ...). `sentence_counts` are token counts of the
+        utils.split_sentences sentences, sliced from the message's token ids.
+        """
+
+    def compress_many(self, requests: Sequence[Tuple[str, int]], hint: Optional[str] = None) -> List[str]:
+        """Compresses each (text, target_tokens) for one hint; override for a native batch path."""
+        return [self.compress(text, target, hint) for text, target in requests]
+
+class _Analysis:
+    """Query-independent facts about one text, reused across compress() calls."""
+    __slots__ = ("token_len", "sentences", "counts", "pos_bias", "len_penalty", "postings", "base",
+                 "min_count", "_order", "_ranked")
+
+    def __init__(self, token_len: int, sentences: List[str], counts: Sequence[int]):
+        self.token_len = token_len
+        self.sentences = sentences
+        self.counts = list(counts)
+        self.min_count = min(self.counts, default=0)
+        self.pos_bias: List[float] = []
+        self.len_penalty: List[float] = []
+        # word -> indices of the sentences containing it (for hint overlap)
+        self.postings: Dict[str, List[int]] = {}
+        self.base = -1  # id of the first sentence in the session index; -1 = not indexed
+        self._order: Optional[List[Tuple[float, int]]] = None
+        self._ranked: List[int] = []
+        for idx, sent in enumerate(sentences):
+            toks = set(simple_tokenize(sent))
+            self.len_penalty.append(max(1, len(toks)) ** 0.15)
+            self.pos_bias.append(1.0 / (1 + idx * 0.05))
+            for tok in toks:
+                self.postings.setdefault(tok, []).append(idx)
+
+    def score(self, idx: int, overlap: int) -> float:
+        return (1 + overlap) * self.pos_bias[idx] / self.len_penalty[idx]
+
+    def ranked(self, overlap: Dict[int, int]):
+        """
+        Sentence indices best first, as a stable sort by descending score.
+        Sentences without hint overlap keep a precomputed order; only the
+        overlapping ones are scored and merged in.
+        """
+        if self._order is None:
+            self._order = sorted((-self.score(i, 0), i) for i in range(len(self.sentences)))
+            self._ranked = [i for _, i in self._order]
+        if not overlap:
+            return self._ranked
+        boosted = sorted((-self.score(i, n), i) for i, n in overlap.items())
+        rest = (key for key in self._order if key[1] not in overlap)
+        return (i for _, i in heapq.merge(boosted, rest))  # lazy: selection usually stops early
+
 class HeuristicCompressor(Compressor):
     """
     Extractive-ish compressor with no external models.
     Scores sentences by hint-overlap, length prior, and early-position bias.
+    The query-independent analysis of a text (sentences, their token counts
+    and word postings) is kept for the last `max_analyses` texts, so a new
+    hint only recomputes overlap and selection. prepare() builds it ahead
+    of time, optionally from sentence counts sliced from token ids.
+    All cached sentences also share a session inverted index (word ->
+    sentence ids); compress_many gets the hint overlap of every sentence of
+    every requested text from one posting walk per hint word.
     """
+    def __init__(self, token_counter: TokenCounter, max_analyses: int = 4096):
+        super().__init__(token_counter)
+        self.max_analyses = max_analyses
+        self._analyses: "OrderedDict[str, _Analysis]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._postings: Dict[str, array] = {}
+        self._next_sentence = 0
+        self._stale = 0  # sentence ids of evicted analyses still in the postings
+
+    def prepare(self, text: str, sentence_counts: Optional[Sequence[int]] = None) -> None:
+        self._analysis(text, sentence_counts)
+
     def compress(self, text: str, target_tokens: int, hint: Optional[str] = None) -> str:
-        if self.tc.count(text) <= target_tokens:
+        a = self._analysis(text)
+        if a.token_len <= target_tokens or not a.sentences:
+            return self._select(a, text, target_tokens, {})
+        return self._select(a, text, target_tokens, _local_overlap(a, set(simple_tokenize(hint or ""))))
+
+    def compress_many(self, requests: Sequence[Tuple[str, int]], hint: Optional[str] = None) -> List[str]:
+        analyses = [self._analysis(text) for text, _ in requests]
+        hint_toks = set(simple_tokenize(hint or ""))
+        with self._lock:
+            overlaps = self._overlaps([a for a in analyses if a.base >= 0], hint_toks)
+        out: List[str] = []
+        for (text, target), a in zip(requests, analyses):
+            overlap = overlaps.get(id(a))
+            if overlap is None:
+                # Evicted before it could be read from the index
+                overlap = _local_overlap(a, hint_toks)
+            out.append(self._select(a, text, target, overlap))
+        return out
+
+    # ---- Internals ----
+
+    def _select(self, a: _Analysis, text: str, target_tokens: int, overlap: Dict[int, int]) -> str:
+        """Greedy extractive selection; `overlap` maps sentence index -> hint words shared (non-zero only)."""
+        if a.token_len <= target_tokens:
             return text
 
-        sentences = split_sentences(text)
+        sentences = a.sentences
         if not sentences:
-            return truncate_to_tokens(text, target_tokens, self.tc)
+            return self.tc.truncate(text, target_tokens)
 
-        hint_toks = set(simple_tokenize(hint or ""))
-        scored: List[Tuple[float, str]] = []
-        for idx, s in enumerate(sentences):
-            toks = set(simple_tokenize(s))
-            overlap = len(toks & hint_toks)
-            len_penalty = max(1, len(toks)) ** 0.15
-            pos_bias = 1.0 / (1 + idx * 0.05)
-            score = (1 + overlap) * pos_bias / len_penalty
-            scored.append((score, s))
-
-        scored.sort(key=lambda x: x[0], reverse=True)
         out: List[str] = []
         used = 0
-        for _, s in scored:
-            need = self.tc.count(s)
+        smallest = a.min_count
+        for idx in a.ranked(overlap):
+            need = a.counts[idx]
             if used + need > target_tokens:
+                if used + smallest > target_tokens:
+                    break  # nothing left can fit
                 continue
-            out.append(s)
+            out.append(sentences[idx])
             used += need
             if used >= target_tokens:
                 break
 
         if not out:
-            return truncate_to_tokens(sentences[0], target_tokens, self.tc)
+            return self.tc.truncate(sentences[0], target_tokens)
         return " ".join(out)
+
+    def _analysis(self, text: str, sentence_counts: Optional[Sequence[int]] = None) -> _Analysis:
+        key = content_hash(text)
+        with self._lock:
+            a = self._analyses.get(key)
+            if a is not None:
+                self._analyses.move_to_end(key)
+                return a
+        sentences = split_sentences(text)
+        if sentence_counts is None or len(sentence_counts) != len(sentences):
+            sentence_counts = self.tc.count_many(sentences)
+        a = _Analysis(self.tc.count(text), sentences, sentence_counts)
+        if self.max_analyses > 0:
+            with self._lock:
+                if key in self._analyses:
+                    return self._analyses[key]
+                self._analyses[key] = a
+                self._index(a)
+                while len(self._analyses) > self.max_analyses:
+                    old = self._analyses.popitem(last=False)[1]
+                    self._stale += len(old.sentences)
+                    old.base = -1
+                if self._stale > max(4096, self._next_sentence // 2):
+                    self._reindex()
+        return a
+
+    def _index(self, a: _Analysis) -> None:
+        a.base = self._next_sentence
+        self._next_sentence += len(a.sentences)
+        for tok, idxs in a.postings.items():
+            post = self._postings.get(tok)
+            if post is None:
+                post = self._postings[tok] = array("i")
+            post.extend(a.base + i for i in idxs)
+
+    def _reindex(self) -> None:
+        """Rebuilds the session index from the live analyses, dropping evicted ids."""
+        self._postings = {}
+        self._next_sentence = self._stale = 0
+        for a in self._analyses.values():
+            self._index(a)
+
+    def _overlaps(self, analyses: Sequence[_Analysis], hint_toks) -> Dict[int, Dict[int, int]]:
+        """Non-zero hint overlaps per sentence for each analysis (keyed by id()), from the session index."""
+        if not analyses:
+            return {}
+        posts = [self._postings[t] for t in hint_toks if t in self._postings]
+        if np is not None:
+            ids = (np.concatenate([np.frombuffer(p, dtype=np.int32) for p in posts])
+                   if posts else np.zeros(0, dtype=np.int32))
+            sids, counts = np.unique(ids, return_counts=True)  # sorted sentence ids
+            bases = np.fromiter((a.base for a in analyses), dtype=np.int64, count=len(analyses))
+            ends = bases + np.fromiter((len(a.sentences) for a in analyses), dtype=np.int64, count=len(analyses))
+            lo, hi = np.searchsorted(sids, bases).tolist(), np.searchsorted(sids, ends).tolist()
+            sids, counts = sids.tolist(), counts.tolist()
+            return {
+                id(a): {sid - a.base: n for sid, n in zip(sids[l:h], counts[l:h])}
+                for a, l, h in zip(analyses, lo, hi)
+            }
+        hits: Dict[int, int] = {}
+        for post in posts:
+            for sid in post:
+                hits[sid] = hits.get(sid, 0) + 1
+        out = {id(a): {} for a in analyses}
+        spans = sorted((a.base, a.base + len(a.sentences), id(a)) for a in analyses)
+        starts = [span[0] for span in spans]
+        for sid, n in hits.items():
+            k = bisect_right(starts, sid) - 1
+            if k >= 0 and sid < spans[k][1]:
+                out[spans[k][2]][sid - spans[k][0]] = n
+        return out
+
+def _local_overlap(a: _Analysis, hint_toks) -> Dict[int, int]:
+    """Non-zero hint overlaps from one analysis' own postings."""
+    overlap: Dict[int, int] = {}
+    for tok in hint_toks:
+        for idx in a.postings.get(tok, ()):
+            overlap[idx] = overlap.get(idx, 0) + 1
+    return overlap
@@ -0,0 +1,137 @@
+# compression_cache.py
+from __future__ import annotations
+
+import hashlib
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+def compressor_id(compressor) -> str:
+    """Identity of a compressor: class plus model name when it has one."""
+    cls = type(compressor)
+    return f"{cls.__module__}.{cls.__qualname__}:{getattr(compressor, 'model', '')}"
+
+class CompressionCache:
+    """
+    Bounded LRU cache of compressor outputs.
+    Keyed by (content hash, target tokens, compressor identity, hint fingerprint).
+    hint_mode:
+      - "exact":     hint text (lowercased, whitespace-collapsed) must match
+      - "embedding": hint query embeddings sharing a SimHash bucket reuse entries
+      - "none":      ignore the hint (one summary per content/target)
+    Entries are evicted LRU-first past `max_entries` or `max_bytes`,
+    and expire after `ttl_s` seconds when set.
+    """
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        max_bytes: int = 16 * 1024 * 1024,
+        ttl_s: Optional[float] = None,
+        hint_mode: str = "exact",
+        hint_bits: int = 12,
+        seed: int = 0,
+    ):
+        if hint_mode not in ("exact", "embedding", "none"):
+            raise ValueError(f"Unknown hint_mode: {hint_mode!r}")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.hint_mode = hint_mode
+        self.hint_bits = hint_bits
+        self._seed = seed
+        self._planes: Optional[List[List[float]]] = None
+        self._entries: "OrderedDict[tuple, Tuple[str, int, float]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(
+        self,
+        digest: str,
+        target_tokens: int,
+        compressor,
+        hint: Optional[str],
+        hint_embedding: Optional[Sequence[float]] = None,
+        hint_fp: Optional[str] = None,
+    ) -> tuple:
+        """Cache key; pass `hint_fp` from hint_fingerprint() to reuse it across items."""
+        if hint_fp is None:
+            hint_fp = self.hint_fingerprint(hint, hint_embedding)
+        return (digest, target_tokens, compressor_id(compressor), hint_fp)
+
+    def hint_fingerprint(self, hint: Optional[str], hint_embedding: Optional[Sequence[float]] = None) -> str:
+        """Hint component of a key, per `hint_mode`."""
+        if self.hint_mode == "none" or not hint:
+            return ""
+        if self.hint_mode == "embedding" and hint_embedding is not None:
+            return "e:" + self._simhash(hint_embedding)
+        return "x:" + content_hash(" ".join(hint.lower().split()))
+
+    def __contains__(self, key: tuple) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and not self._expired(entry)
+
+    def get(self, key: tuple) -> Optional[Tuple[str, int]]:
+        """Returns (text, token_len) and marks the entry recently used."""
+        entry = self._entries.get(key)
+        if entry is None or self._expired(entry):
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, key: tuple, text: str, token_len: int) -> None:
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (text, token_len, time.time())
+        self._bytes += _entry_bytes(text)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "entries": float(len(self._entries)),
+            "bytes": float(self._bytes),
+            "hits": float(self.hits),
+            "misses": float(self.misses),
+            "evictions": float(self.evictions),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    # ---- Internals ----
+
+    def _expired(self, entry: Tuple[str, int, float]) -> bool:
+        return self.ttl_s is not None and time.time() - entry[2] > self.ttl_s
+
+    def _drop(self, key: tuple) -> None:
+        text = self._entries.pop(key)[0]
+        self._bytes -= _entry_bytes(text)
+
+    def _simhash(self, vec: Sequence[float]) -> str:
+        """Sign pattern of `hint_bits` fixed random projections."""
+        if self._planes is None or len(self._planes[0]) != len(vec):
+            rng = random.Random(self._seed)
+            self._planes = [[rng.gauss(0.0, 1.0) for _ in range(len(vec))]
+                            for _ in range(self.hint_bits)]
+        bits = 0
+        for plane in self._planes:
+            bits = (bits << 1) | (sum(p * x for p, x in zip(plane, vec)) >= 0.0)
+        return format(bits, "x")
+
+def _entry_bytes(text: str) -> int:
+    return len(text.encode("utf-8")) + 64  # rough per-entry overhead
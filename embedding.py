@@ -1,29 +1,144 @@
 # embedding.py
 from __future__ import annotations
 
-from typing import List
-from utils import simple_tokenize, l2_normalize_inplace
+import asyncio
+import hashlib
+import threading
+from typing import Dict, List, Sequence
+from utils import SparseVector, simple_tokenize, l2_normalize_inplace
+
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+if np is not None:
+    _HASH_MASK = np.uint64(0x7FFFFFFFFFFFFFFF)
 
 class Embedder:
     """Interface for producing vector embeddings for text."""
     dim: int
+    deterministic: bool = True  # same text -> same vector in every process (caches rely on it)
 
     def encode(self, text: str) -> List[float]:  # pragma: no cover
         raise NotImplementedError
 
+    def encode_many(self, texts: Sequence[str]) -> List[List[float]]:
+        """Batch encode; override when the backend has a native batch call."""
+        return [self.encode(t) for t in texts]
+
+    async def aencode(self, text: str) -> List[float]:
+        """Async encode; the default runs `encode` in a worker thread."""
+        return await asyncio.to_thread(self.encode, text)
+
+    async def aencode_many(self, texts: Sequence[str]) -> List[List[float]]:
+        """Async batch encode; the default runs `encode_many` in a worker thread."""
+        return await asyncio.to_thread(self.encode_many, list(texts))
+
 class HashingEmbedder(Embedder):
     """
     Dependency-free feature hashing embedder.
     Fast/stable for demos; swap for OpenAI/HF in prod.
+    With stable=True, tokens are hashed with blake2b instead of the
+    per-process randomized hash(), so vectors are identical across
+    processes and restarts; token hashes are memoized and vectors are
+    built with NumPy bincount when available.
+    With sparse=True, vectors are returned as SparseVector (a short message
+    has only a handful of non-zeros), which FocusManager scores through an
+    inverted index.
     """
-    def __init__(self, dim: int = 512):
+    def __init__(
+        self,
+        dim: int = 512,
+        stable: bool = False,
+        memo_size: int = 1 << 16,
+        sparse: bool = False,
+    ):
         self.dim = dim
+        self.stable = stable
+        self.sparse = sparse
+        self.memo_size = memo_size
+        self._memo: Dict[str, int] = {}
+        self._memo_lock = threading.Lock()  # encode may run on several embed workers
+        self.deterministic = stable  # hash() is salted per process
+        if stable:
+            self.model = "hashing-blake2b"  # cache identity, see CachingEmbedder
 
     def encode(self, text: str) -> List[float]:
+        if self.stable:
+            return self.encode_many([text])[0]
         vec = [0.0] * self.dim
         for i, tok in enumerate(simple_tokenize(text)):
             bucket = (hash(tok) ^ (i * 0x9E3779B1)) % self.dim
             sign = -1.0 if (hash(tok + "$") & 1) else 1.0
             vec[bucket] += sign
         l2_normalize_inplace(vec)
+        return SparseVector.from_dense(vec) if self.sparse else vec
+
+    def encode_many(self, texts: Sequence[str]) -> List[List[float]]:
+        if not self.stable:
+            return [self.encode(t) for t in texts]
+        if np is None:
+            vecs = [self._encode_stable_python(t) for t in texts]
+            return [SparseVector.from_dense(v) for v in vecs] if self.sparse else vecs
+
+        n = len(texts)
+        token_lists = [simple_tokenize(t) for t in texts]
+        lengths = [len(toks) for toks in token_lists]
+        flat_toks = [tok for toks in token_lists for tok in toks]
+        if not flat_toks:
+            return [SparseVector([], [], self.dim) if self.sparse else [0.0] * self.dim
+                    for _ in range(n)]
+        codes = np.fromiter(self._codes(flat_toks), dtype=np.uint64, count=len(flat_toks))
+
+        # Row id and in-message position for every token
+        rows = np.repeat(np.arange(n, dtype=np.int64), lengths)
+        starts = np.repeat(np.cumsum([0] + lengths[:-1]), lengths)
+        pos = (np.arange(len(flat_toks), dtype=np.int64) - starts).astype(np.uint64)
+
+        buckets = ((codes & _HASH_MASK) ^ (pos * np.uint64(0x9E3779B1))) % np.uint64(self.dim)
+        signs = 1.0 - 2.0 * (codes >> np.uint64(63)).astype(np.float64)
+        flat = rows * self.dim + buckets.astype(np.int64)
+        mat = np.bincount(flat, weights=signs, minlength=n * self.dim).reshape(n, self.dim)
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        mat /= norms
+        if self.sparse:
+            out = []
+            for row in mat:
+                nz = np.flatnonzero(row)
+                out.append(SparseVector(nz.tolist(), row[nz].tolist(), self.dim))
+            return out
+        return mat.tolist()
+
+    # ---- Internals ----
+
+    def _codes(self, toks: List[str]):
+        """
+        Stable per-token codes from a bounded memo table:
+        low 63 bits = blake2b hash, top bit = sign.
+        Codes are resolved into a local table first, so clearing a full memo
+        never loses a code this call still needs.
+        """
+        local: Dict[str, int] = {}
+        with self._memo_lock:
+            memo = self._memo
+            for tok in set(toks):
+                code = memo.get(tok)
+                if code is None:
+                    digest = hashlib.blake2b(tok.encode("utf-8"), digest_size=8).digest()
+                    code = int.from_bytes(digest, "little")
+                    if len(memo) >= self.memo_size:
+                        memo.clear()
+                    memo[tok] = code
+                local[tok] = code
+        return [local[tok] for tok in toks]
+
+    def _encode_stable_python(self, text: str) -> List[float]:
+        toks = simple_tokenize(text)
+        vec = [0.0] * self.dim
+        for i, code in enumerate(self._codes(toks)):
+            sign = -1.0 if code >> 63 else 1.0
+            vec[((code & 0x7FFFFFFFFFFFFFFF) ^ (i * 0x9E3779B1)) % self.dim] += sign
+        l2_normalize_inplace(vec)
         return vec
@@ -0,0 +1,193 @@
+# embedding_cache.py
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import struct
+import threading
+import time
+from typing import Dict, List, Sequence
+
+from embedding import Embedder
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key BLOB PRIMARY KEY,
+    dtype TEXT NOT NULL,
+    vec BLOB NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used);
+CREATE TABLE IF NOT EXISTS cache_meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+_FORMATS = {"float32": "f", "float16": "e"}
+
+def _pack(vec: Sequence[float], dtype: str) -> bytes:
+    return struct.pack(f"<{len(vec)}{_FORMATS[dtype]}", *vec)
+
+def _unpack(blob: bytes, dtype: str) -> List[float]:
+    fmt = _FORMATS[dtype]
+    return list(struct.unpack(f"<{len(blob) // struct.calcsize(fmt)}{fmt}", blob))
+
+class CachingEmbedder(Embedder):
+    """
+    Content-addressed on-disk cache around any Embedder.
+    Vectors are keyed by (model name, dim, content hash) and stored as
+    float32 or float16 blobs in a SQLite file (WAL mode), so several worker
+    processes can share one cache. Least-recently-used rows are evicted past
+    `max_entries`; a hit refreshes its row's last_used at most once per
+    `touch_interval_s`, so repeated hits stay read-only. The row count is
+    kept in a cache_meta table. Inner embedders whose `deterministic` is
+    False (e.g. HashingEmbedder without stable=True) are rejected.
+    """
+    def __init__(
+        self,
+        inner: Embedder,
+        path: str,
+        max_entries: int = 200_000,
+        dtype: str = "float32",
+        touch_interval_s: float = 60.0,
+    ):
+        if dtype not in _FORMATS:
+            raise ValueError(f"Unsupported dtype: {dtype!r}")
+        if not getattr(inner, "deterministic", True):
+            raise ValueError(f"{type(inner).__name__} is not deterministic across processes; "
+                             "its vectors cannot be cached by content.")
+        self.inner = inner
+        self.path = path
+        self.max_entries = max_entries
+        self.dtype = dtype
+        self.touch_interval_s = touch_interval_s
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # One-time count for caches created before cache_meta existed
+        self._conn.execute("INSERT OR IGNORE INTO cache_meta (name, value) "
+                           "SELECT 'entries', COUNT(*) FROM embeddings")
+        self._conn.commit()
+
+    @property
+    def dim(self) -> int:
+        return self.inner.dim
+
+    @property
+    def model(self) -> str:
+        return getattr(self.inner, "model", None) or type(self.inner).__name__
+
+    def encode(self, text: str) -> List[float]:
+        return self.encode_many([text])[0]
+
+    def encode_many(self, texts: Sequence[str]) -> List[List[float]]:
+        keys, found, missing = self._partition(texts)
+        if missing:
+            self._fill(found, missing, self.inner.encode_many(list(missing.values())))
+        return [list(found[k]) for k in keys]
+
+    async def aencode(self, text: str) -> List[float]:
+        return (await self.aencode_many([text]))[0]
+
+    async def aencode_many(self, texts: Sequence[str]) -> List[List[float]]:
+        keys, found, missing = self._partition(texts)
+        if missing:
+            self._fill(found, missing, await self.inner.aencode_many(list(missing.values())))
+        return [list(found[k]) for k in keys]
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        with self._lock:
+            entries = self._entries()
+        return {
+            "entries": float(entries),
+            "hits": float(self.hits),
+            "misses": float(self.misses),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # ---- Internals ----
+
+    def _partition(self, texts: Sequence[str]):
+        """Returns (keys, cached vectors, uncached key -> text) and counts hits/misses."""
+        keys = [self._key(t) for t in texts]
+        found = self._lookup(set(keys))
+        missing: Dict[bytes, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        n_missing = sum(1 for k in keys if k not in found)
+        self.misses += n_missing
+        self.hits += len(keys) - n_missing
+        return keys, found, missing
+
+    def _fill(self, found: Dict[bytes, List[float]], missing: Dict[bytes, str], vecs) -> None:
+        fresh = dict(zip(missing.keys(), vecs))
+        self._store(fresh)
+        found.update(fresh)
+
+    def _key(self, text: str) -> bytes:
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{self.model}\0{getattr(self.inner, 'dim', '')}\0".encode("utf-8"))
+        h.update(text.encode("utf-8"))
+        return h.digest()
+
+    def _lookup(self, keys: set) -> Dict[bytes, List[float]]:
+        out: Dict[bytes, List[float]] = {}
+        if not keys:
+            return out
+        keys = list(keys)
+        now = time.time()
+        stale: List[bytes] = []
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, dtype, vec, last_used FROM embeddings WHERE key IN ({marks})", part
+                ).fetchall()
+                for key, dtype, blob, last_used in rows:
+                    out[key] = _unpack(blob, dtype)
+                    if now - last_used >= self.touch_interval_s:
+                        stale.append(key)
+            if stale:
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in stale])
+                self._conn.commit()
+        return out
+
+    def _store(self, vecs: Dict[bytes, List[float]]) -> None:
+        now = time.time()
+        with self._lock:
+            # Rows another process stored meanwhile hold the same vector
+            changes = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, dtype, vec, last_used) VALUES (?, ?, ?, ?)",
+                [(k, self.dtype, _pack(v, self.dtype), now) for k, v in vecs.items()],
+            )
+            self._add_entries(self._conn.total_changes - changes)
+            count = self._entries()
+            if count > self.max_entries:
+                changes = self._conn.total_changes
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+                self._add_entries(changes - self._conn.total_changes)
+            self._conn.commit()
+
+    def _entries(self) -> int:
+        return self._conn.execute("SELECT value FROM cache_meta WHERE name = 'entries'").fetchone()[0]
+
+    def _add_entries(self, delta: int) -> None:
+        if delta:
+            self._conn.execute("UPDATE cache_meta SET value = value + ? WHERE name = 'entries'", (delta,))
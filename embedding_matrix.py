@@ -0,0 +1,223 @@
+# embedding_matrix.py
+from __future__ import annotations
+
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+from utils import SparseVector, cosine
+
+_DTYPES = ("float32", "float16", "int8")
+_SCORE_CHUNK = 1024  # rows dequantized at a time when scoring
+
+class EmbeddingMatrix:
+    """
+    Row-per-item embedding store used by FocusManager for scoring.
+    With NumPy, rows live in one contiguous buffer that grows in chunks,
+    so scoring all items is a single matrix-vector product.
+    Without NumPy, rows are kept as plain lists and scored one by one.
+    dtype="float16" or "int8" (per-row scale) stores rows quantized and
+    dequantizes them chunk by chunk while scoring.
+    """
+    def __init__(self, dim: Optional[int] = None, chunk_rows: int = 1024, dtype: str = "float32"):
+        if dtype not in _DTYPES:
+            raise ValueError(f"Unsupported embedding dtype: {dtype!r}")
+        self.dim = dim
+        self.chunk_rows = max(1, chunk_rows)
+        self.dtype = dtype
+        self._n = 0
+        self._buf = None                     # np.ndarray (capacity, dim)
+        self._scales = None                  # np.ndarray (capacity,) for int8
+        self._rows: List[List[float]] = []   # pure-Python fallback
+
+    def __len__(self) -> int:
+        return self._n
+
+    @property
+    def vectorized(self) -> bool:
+        return np is not None
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes used by the stored rows (excluding spare capacity)."""
+        if self._buf is None:
+            return 0
+        per_row = self._buf.itemsize * self.dim + (4 if self._scales is not None else 0)
+        return per_row * self._n
+
+    def append(self, vec: Sequence[float]) -> int:
+        """Adds one row and returns its index."""
+        return self.extend([vec])[0]
+
+    def extend(self, vecs: Sequence[Sequence[float]]) -> range:
+        """Adds rows in one block copy and returns their indices."""
+        start = self._n
+        if len(vecs) == 0:
+            return range(start, start)
+        if np is None:
+            self._rows.extend(list(_dense(v)) for v in vecs)
+        else:
+            if not (isinstance(vecs, np.ndarray) and vecs.ndim == 2):
+                vecs = [_dense(v) for v in vecs]
+            block = np.asarray(vecs, dtype=np.float32)
+            self._reserve(start + len(block), block.shape[1])
+            self._put(start, block)
+        self._n += len(vecs)
+        return range(start, self._n)
+
+    def set(self, row: int, vec: Sequence[float]) -> None:
+        vec = _dense(vec)
+        if np is None:
+            self._rows[row] = list(vec)
+        else:
+            self._put(row, np.asarray([vec], dtype=np.float32))
+
+    def rows(self, idx):
+        """float32 copy of the selected rows (index array or slice; NumPy only)."""
+        if self._buf is None:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        if isinstance(idx, slice):
+            idx = slice(*idx.indices(self._n))
+        block = self._buf[idx].astype(np.float32)
+        if self._scales is not None:
+            block *= self._scales[idx][:, None]
+        return block
+
+    def scores(self, query: Sequence[float]):
+        """Dot product of every row with `query` (cosine for L2-normalized rows)."""
+        if np is None:
+            return [cosine(query, row) for row in self._rows]
+        if self._n == 0:
+            return np.zeros(0, dtype=np.float64)
+        q = np.asarray(query, dtype=np.float32)
+        if self.dtype == "float32":
+            return (self._buf[: self._n] @ q).astype(np.float64)
+        out = np.empty(self._n, dtype=np.float64)
+        for a in range(0, self._n, _SCORE_CHUNK):
+            b = min(self._n, a + _SCORE_CHUNK)
+            out[a:b] = self._buf[a:b].astype(np.float32) @ q
+            if self._scales is not None:
+                out[a:b] *= self._scales[a:b]
+        return out
+
+    def scores_for(self, rows, query: Sequence[float]):
+        """Dot products for a subset of rows only (NumPy only)."""
+        q = np.asarray(query, dtype=np.float32)
+        return (self.rows(rows) @ q).astype(np.float64)
+
+    # ---- Internals ----
+
+    def _put(self, start: int, block) -> None:
+        stop = start + len(block)
+        if self.dtype == "int8":
+            scales = np.abs(block).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self._buf[start:stop] = np.rint(block / scales[:, None])
+            self._scales[start:stop] = scales
+        else:
+            self._buf[start:stop] = block
+
+    def _reserve(self, rows: int, dim: int) -> None:
+        if self._buf is None:
+            self.dim = self.dim or dim
+            cap = max(rows, self.chunk_rows)
+            self._buf = self._allocate(cap)
+            if self.dtype == "int8":
+                self._scales = np.ones(cap, dtype=np.float32)
+        if dim != self.dim:
+            raise ValueError(f"Embedding dim {dim} does not match matrix dim {self.dim}.")
+        cap = self._buf.shape[0]
+        if rows <= cap:
+            return
+        # Grow by at least one chunk, geometrically for large sessions
+        new_cap = max(rows, cap + max(self.chunk_rows, cap // 2))
+        self._buf = self._grow(new_cap)
+        if self._scales is not None:
+            scales = np.ones(new_cap, dtype=np.float32)
+            scales[: self._n] = self._scales[: self._n]
+            self._scales = scales
+
+    def _allocate(self, capacity: int):
+        return np.zeros((capacity, self.dim), dtype=np.dtype(self.dtype))
+
+    def _grow(self, capacity: int):
+        grown = self._allocate(capacity)
+        grown[: self._n] = self._buf[: self._n]
+        return grown
+
+class SparseIndex:
+    """
+    Inverted index over SparseVector rows: dimension -> (rows, values).
+    Drop-in for EmbeddingMatrix when the embedder is sparse; scoring a query
+    touches only the postings of its non-zero dimensions.
+    """
+    def __init__(self, dim: Optional[int] = None):
+        self.dim = dim
+        self._n = 0
+        self._postings: Dict[int, Tuple[array, array]] = {}
+
+    def __len__(self) -> int:
+        return self._n
+
+    @property
+    def vectorized(self) -> bool:
+        return np is not None
+
+    def append(self, vec) -> int:
+        vec = _sparse(vec)
+        self.dim = self.dim or vec.dim
+        row = self._n
+        for i, v in zip(vec.indices, vec.values):
+            rows, vals = self._postings.setdefault(i, (array("i"), array("d")))
+            rows.append(row)
+            vals.append(v)
+        self._n += 1
+        return row
+
+    def extend(self, vecs) -> range:
+        start = self._n
+        for vec in vecs:
+            self.append(vec)
+        return range(start, self._n)
+
+    def set(self, row: int, vec) -> None:
+        for rows, vals in self._postings.values():
+            if row in rows:
+                at = rows.index(row)
+                del rows[at]
+                del vals[at]
+        for i, v in zip(_sparse(vec).indices, _sparse(vec).values):
+            rows, vals = self._postings.setdefault(i, (array("i"), array("d")))
+            rows.append(row)
+            vals.append(v)
+
+    def scores(self, query):
+        query = _sparse(query)
+        if np is None:
+            out = [0.0] * self._n
+            for i, qv in zip(query.indices, query.values):
+                post = self._postings.get(i)
+                if post:
+                    for row, v in zip(*post):
+                        out[row] += v * qv
+            return out
+        out = np.zeros(self._n, dtype=np.float64)
+        for i, qv in zip(query.indices, query.values):
+            post = self._postings.get(i)
+            if post:
+                # Rows are unique within one posting list, so fancy += is safe
+                out[np.frombuffer(post[0], dtype=np.int32)] += np.frombuffer(post[1]) * qv
+        return out
+
+    def scores_for(self, rows, query):
+        return self.scores(query)[rows]
+
+def _dense(vec):
+    return vec.to_dense() if isinstance(vec, SparseVector) else vec
+
+def _sparse(vec) -> SparseVector:
+    return vec if isinstance(vec, SparseVector) else SparseVector.from_dense(vec)
@@ -1,14 +1,27 @@
 # focus.py
 from __future__ import annotations
 
+import heapq
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
-from typing import List, Optional, Tuple, Dict
+from array import array
+from itertools import islice
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
 
 from token_counter import TokenCounter
 from embedding import Embedder
+from embedding_matrix import EmbeddingMatrix, SparseIndex
+from ann_index import IVFIndex
 from compression import Compressor, HeuristicCompressor
-from utils import cosine, truncate_to_tokens
+from compression_cache import CompressionCache, content_hash
+from utils import cosine
 
 class Fidelity:
     FULL = "FULL"
@@ -21,11 +34,20 @@ class MemoryItem:
     role: str   # "user" | "assistant" | "system"
     content: str
     created_at_s: float = field(default_factory=lambda: time.time())
-    token_len: int = 0
+    token_len: int = 0      # exact count, or the estimator's high estimate when token_exact is False
     embedding: Optional[List[float]] = None
     compression_state: str = Fidelity.FULL
     compressed_text: Optional[str] = None
-    last_score: float = 0.0  # diagnostic
+    last_score: float = 0.0  # diagnostic; with a store, only emitted items are updated
+    # Cached stub variant; rebuilt when max_placeholder_tokens changes
+    stub_text: Optional[str] = None
+    stub_len: int = 0
+    stub_budget: int = 0
+    content_hash: str = ""
+    token_exact: bool = True
+    token_lo: int = 0       # estimator low estimate (0 = unknown) while token_exact is False
+    token_ids: Optional[array] = None      # array('I') when FocusConfig.keep_token_ids
+    sentence_ends: Optional[array] = None  # token offset of each sentence end in token_ids
 
 @dataclass
 class FocusConfig:
@@ -34,11 +56,49 @@ class FocusConfig:
     recency_half_life: int = 12     # turns; lower = more recency bias
     max_placeholder_tokens: int = 12
     default_compress_ratio: float = 0.35  # target compressed size vs original
+    use_ann_index: bool = False     # score only ANN top-K + recent window (needs numpy)
+    ann_top_k: int = 64
+    ann_recent_window: int = 32
+    ann_nprobe: int = 8
+    packing: str = "chronological"  # or "priority": spend budget by relevance per token
+    compress_workers: int = 1       # >1 runs cache-miss compressions on a thread pool
+    compress_timeout_s: Optional[float] = None  # deadline for a turn's parallel compressions; late items are stubbed
+    embedding_dtype: str = "float32"  # or "float16" / "int8": quantized matrix, items drop their lists
+    coarse_dims: int = 0            # >0: first-pass scoring on a renormalized prefix of this many dims
+    coarse_margin: float = 0.05     # coarse scores this close to a threshold are rescored in full
+    embed_workers: int = 0          # >0: add_message embeds on a thread pool; build_context joins
+    embedding_memo_size: int = 64   # recent text embeddings reused as build_context queries
+    estimate_tokens: bool = False   # ingest with calibrated estimates; exact counts only before emitting or compressing
+    keep_token_ids: bool = False    # keep token ids per item; stubs and sentence counts slice them
+    prepare_compression: bool = False  # run the compressor's per-text analysis at ingest
+
+_FIDELITY_BANDS = (Fidelity.PLACEHOLDER, Fidelity.COMPRESSED, Fidelity.FULL)
+
+# Variants tried, best first, for each planned fidelity
+_FALLBACKS = {
+    Fidelity.FULL: (Fidelity.FULL, Fidelity.COMPRESSED, Fidelity.PLACEHOLDER),
+    Fidelity.COMPRESSED: (Fidelity.COMPRESSED, Fidelity.PLACEHOLDER),
+    Fidelity.PLACEHOLDER: (Fidelity.PLACEHOLDER,),
+}
+
+# Share of an item's relevance score a variant is worth in priority packing
+_VARIANT_VALUE = {Fidelity.FULL: 1.0, Fidelity.COMPRESSED: 0.6, Fidelity.PLACEHOLDER: 0.1}
+
+def _prefix(block, dims: int):
+    """First `dims` columns of each row, L2-renormalized (Matryoshka-style truncation)."""
+    head = block[:, :dims]
+    norms = np.linalg.norm(head, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return head / norms
 
 class FocusManager:
     """
     Dynamic focus controller:
     - Scores each past turn by (cosine similarity to query) * recency weight.
+      Embeddings are kept in a columnar EmbeddingMatrix so scoring is one
+      matrix-vector product when NumPy is available (or in a SparseIndex
+      for sparse embedders). With embed_workers > 0, add_message embeds in
+      the background and build_context joins pending rows before scoring.
     - Assigns fidelity (FULL/COMPRESSED/PLACEHOLDER).
     - Packs messages under a token budget, expanding/contracting as needed.
     """
@@ -49,66 +109,164 @@ class FocusManager:
         token_counter: TokenCounter,
         compressor: Optional[Compressor] = None,
         config: Optional[FocusConfig] = None,
+        compression_cache: Optional[CompressionCache] = None,
+        store=None,
     ):
         self.embedder = embedder
         self.tc = token_counter
         self.compressor = compressor or HeuristicCompressor(token_counter)
         self.cfg = config or FocusConfig()
-        self._items: List[MemoryItem] = []
-        self._next_id = 1
+        self.compression_cache = compression_cache if compression_cache is not None else CompressionCache()
+        if store is not None and self.cfg.embedding_dtype != "float32":
+            raise ValueError("A store keeps float32 embeddings; "
+                             f"embedding_dtype={self.cfg.embedding_dtype!r} needs an in-memory session.")
+        if store is not None and self.cfg.embed_workers > 0:
+            # The store persists an item as soon as it is appended
+            raise ValueError("embed_workers requires an in-memory session; a store would "
+                             "persist items before their embeddings exist.")
+        # Optional persistent store (e.g. item_store.MmapItemStore); it acts
+        # as the item list and owns the embedding matrix
+        self._items: List[MemoryItem] = store if store is not None else []
+        if store is not None:
+            self._matrix = store.matrix
+            self._next_id = store.next_id
+        else:
+            if getattr(embedder, "sparse", False):
+                self._matrix = SparseIndex(dim=getattr(embedder, "dim", None))
+            else:
+                self._matrix = EmbeddingMatrix(dim=getattr(embedder, "dim", None),
+                                               dtype=self.cfg.embedding_dtype)
+            self._next_id = 1
+        # Quantized rows are the only copy; items keep no float lists
+        self._keep_item_embeddings = self.cfg.embedding_dtype == "float32" or np is None
+        dense = np is not None and isinstance(self._matrix, EmbeddingMatrix)
+        self._ann: Optional[IVFIndex] = None
+        if self.cfg.use_ann_index and dense:
+            self._ann = IVFIndex(self._matrix, nprobe=self.cfg.ann_nprobe)
+            self._ann.sync(len(self._matrix))
+        # Low-dimensional prefix copy for coarse-to-fine scoring; a prefix
+        # as wide as the embeddings saves nothing, so coarse scoring is off
+        self._coarse: Optional[EmbeddingMatrix] = None
+        if 0 < self.cfg.coarse_dims < (self._matrix.dim or float("inf")) and dense:
+            self._coarse = EmbeddingMatrix(dim=self.cfg.coarse_dims, dtype=self.cfg.embedding_dtype)
+            for start in range(0, len(self._matrix), 8192):
+                block = self._matrix.rows(slice(start, start + 8192))
+                self._coarse.extend(_prefix(block, self.cfg.coarse_dims))
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_workers = 0
+        # Background embeddings, in item order, for items not yet in the matrix
+        self._pending: Deque[Tuple[MemoryItem, Future]] = deque()
+        self._embed_pool: Optional[ThreadPoolExecutor] = None
+        # content hash -> embedding (or its pending Future), LRU-bounded
+        self._memo: "OrderedDict[str, object]" = OrderedDict()
+        self._exact_counts = 0
 
     # ---- Public API ----
 
     def add_message(self, role: str, content: str) -> MemoryItem:
-        item = MemoryItem(id=self._next_id, role=role, content=content)
-        self._next_id += 1
-        item.token_len = self.tc.count(content)
+        item = self._new_item(role, content)
+        if self.cfg.embed_workers > 0:
+            # Return at once; the row is indexed when build_context joins it
+            fut = self._embedding_pool().submit(self.embedder.encode, content)
+            self._items.append(item)
+            self._pending.append((item, fut))
+            self._remember(item.content_hash, fut)
+            return item
         item.embedding = self.embedder.encode(content)
+        self._remember(item.content_hash, item.embedding)
         self._items.append(item)
+        self._index_embeddings([item.embedding])
+        if not self._keep_item_embeddings:
+            item.embedding = None
         return item
 
+    def add_messages(
+        self,
+        messages: Iterable[Tuple[str, str]],
+        chunk_size: int = 256,
+    ) -> Dict[str, float]:
+        """
+        Bulk ingestion of (role, content) pairs.
+        Consumes the iterable in chunks so memory stays bounded; each chunk is
+        embedded with one encode_many call and token-counted with count_many.
+        Returns throughput stats.
+        """
+        t0 = time.perf_counter()
+        total = 0
+        self.join_embeddings()
+        source = iter(messages)
+        while True:
+            chunk = list(islice(source, max(1, chunk_size)))
+            if not chunk:
+                break
+            contents = [content for _, content in chunk]
+            # Estimates and kept token ids are per item; plain counts are batched
+            per_item = self.cfg.estimate_tokens or self.cfg.keep_token_ids
+            token_lens = [None] * len(chunk) if per_item else self.tc.count_many(contents)
+            embeddings = self.embedder.encode_many(contents)
+            items = []
+            for (role, content), emb, ntok in zip(chunk, embeddings, token_lens):
+                item = self._new_item(role, content, ntok)
+                if self._keep_item_embeddings:
+                    item.embedding = emb
+                self._remember(item.content_hash, emb)
+                items.append(item)
+            self._items.extend(items)
+            self._index_embeddings(embeddings)
+            total += len(items)
+        elapsed = time.perf_counter() - t0
+        return {
+            "messages": float(total),
+            "seconds": elapsed,
+            "messages_per_s": total / elapsed if elapsed > 0 else 0.0,
+        }
+
     def build_context(
         self,
-        current_query: str,
+        current_query: Optional[str],
         budget_tokens: int,
         system_preamble: Optional[str] = None,
+        query_embedding: Optional[List[float]] = None,
+        query_item_id: Optional[int] = None,
     ) -> Tuple[List[Tuple[str, str]], Dict[str, float]]:
         """
         Returns (context_messages, stats).
         context_messages: list[(role, content)] ready for a chat API.
+        The query vector is `query_embedding` when given, else the embedding
+        of item `query_item_id`, else `current_query` embedded through the
+        memo of recent texts (so a just-added message is not re-encoded).
+        current_query is also the compression hint; it defaults to the
+        query item's content.
         """
-        q_emb = self.embedder.encode(current_query)
-
-        # Score items by relevance * recency
-        n = len(self._items)
-        scored: List[Tuple[float, MemoryItem]] = []
-        for idx, it in enumerate(self._items):
-            if not it.embedding:
-                it.embedding = self.embedder.encode(it.content)
-            sim = cosine(q_emb, it.embedding)
-            turns_ago = (n - 1) - idx
-            half = max(1, self.cfg.recency_half_life)
-            recency_weight = 0.5 ** (turns_ago / half)
-            score = max(0.0, sim) * (0.25 + 0.75 * recency_weight)
-            it.last_score = score
-            scored.append((score, it))
+        query_embed_calls = 0
+        if query_embedding is not None:
+            q_emb = query_embedding
+            embeddings_joined = self.join_embeddings()
+        elif query_item_id is not None:
+            embeddings_joined = self.join_embeddings()
+            q_item, q_emb = self._item_embedding(query_item_id)
+            if current_query is None:
+                current_query = q_item.content
+        else:
+            # Pending item embeddings keep running while the query is encoded
+            q_emb, query_embed_calls = self._query_embedding(current_query)
+            embeddings_joined = self.join_embeddings()
 
-        # Plan fidelity by thresholds
-        desired_map: Dict[int, str] = {}
-        for score, it in scored:
-            if score >= self.cfg.high_threshold:
-                desired_map[it.id] = Fidelity.FULL
-            elif score >= self.cfg.mid_threshold:
-                desired_map[it.id] = Fidelity.COMPRESSED
-            else:
-                desired_map[it.id] = Fidelity.PLACEHOLDER
+        # Score items by relevance * recency, then plan fidelity by thresholds
+        scores, items_scored = self._score_items(q_emb)
+        plan = self._plan_fidelity(scores)
+        score_list = scores if isinstance(scores, list) else scores.tolist()
+        if isinstance(self._items, list):
+            for it, score in zip(self._items, score_list):
+                it.last_score = score
 
         messages: List[Tuple[str, str]] = []
         budget_left = budget_tokens
 
-        def try_add(role: str, text: str) -> bool:
+        def try_add(role: str, text: str, need: Optional[int] = None) -> bool:
             nonlocal budget_left
-            need = self.tc.count(text)
+            if need is None:
+                need = self.tc.count(text)
             if need <= budget_left:
                 messages.append((role, text))
                 budget_left -= need
@@ -120,97 +278,497 @@ class FocusManager:
             try_add("system", system_preamble)
 
         used_tokens = raw_tokens = compressed_tokens = placeholder_tokens = 0
+        exact_before = self._exact_counts
         expanded_count = compressed_count = stub_count = 0
+        compress_calls = compress_calls_avoided = compress_timeouts = 0
 
-        def compress_item(it: MemoryItem) -> str:
-            target = max(1, int(it.token_len * self.cfg.default_compress_ratio))
-            return self.compressor.compress(it.content, target, hint=current_query)
+        cache = self.compression_cache
+        cache_hits, cache_misses = cache.hits, cache.misses
+        # The query is fixed for this call, so its hint fingerprint is too
+        hint_fp = cache.hint_fingerprint(current_query, q_emb)
 
-        # Emit in chronological order; fidelity decided by relevance plan
-        ordered_items = sorted(self._items, key=lambda x: x.id)
+        def compression_key(it: MemoryItem) -> tuple:
+            if not it.content_hash:
+                it.content_hash = content_hash(it.content)
+            return cache.key(it.content_hash, self._compress_target(it), self.compressor,
+                             current_query, hint_fp=hint_fp)
 
-        for it in ordered_items:
-            desired = desired_map[it.id]
+        prefetched: Dict[tuple, str] = {}
+        timed_out = set()
 
-            if desired == Fidelity.FULL:
-                if try_add(it.role, it.content):
-                    used_tokens += it.token_len
-                    raw_tokens += it.token_len
-                    expanded_count += 1
-                    it.compression_state = Fidelity.FULL
-                    continue
-                # fallback to compressed
-                comp = it.compressed_text or compress_item(it)
-                it.compressed_text = comp
-                if try_add(it.role, comp):
-                    ctok = self.tc.count(comp)
-                    used_tokens += ctok
-                    compressed_tokens += ctok
-                    compressed_count += 1
-                    it.compression_state = Fidelity.COMPRESSED
-                    continue
-                # fallback to stub
-                stub = self._make_stub(it)
-                if try_add(it.role, stub):
-                    stok = self.tc.count(stub)
-                    used_tokens += stok
-                    placeholder_tokens += stok
-                    stub_count += 1
-                    it.compression_state = Fidelity.PLACEHOLDER
-
-            elif desired == Fidelity.COMPRESSED:
-                comp = it.compressed_text or compress_item(it)
-                it.compressed_text = comp
-                if try_add(it.role, comp):
-                    ctok = self.tc.count(comp)
-                    used_tokens += ctok
-                    compressed_tokens += ctok
-                    compressed_count += 1
-                    it.compression_state = Fidelity.COMPRESSED
+        def prefetch(items: List[MemoryItem]) -> None:
+            """Runs the cache-miss compressions for `items` in one batch or concurrently."""
+            nonlocal compress_calls, compress_timeouts
+            jobs: Dict[tuple, MemoryItem] = {}
+            for it in items:
+                key = compression_key(it)
+                if key not in cache and key not in jobs:
+                    jobs[key] = it
+            if not jobs:
+                return
+            if batched:
+                texts = self.compressor.compress_many(
+                    [(it.content, key[1]) for key, it in jobs.items()], hint=current_query)
+                prefetched.update(zip(jobs.keys(), texts))
+                compress_calls += len(jobs)
+                return
+            pool = self._compress_pool()
+            futures = {
+                pool.submit(self.compressor.compress, it.content, key[1], current_query): key
+                for key, it in jobs.items()
+            }
+            compress_calls += len(futures)
+            # One deadline for the whole batch, counted from submission
+            done, late = wait(futures, timeout=self.cfg.compress_timeout_s)
+            for fut in done:
+                prefetched[futures[fut]] = fut.result()
+            for fut in late:
+                fut.cancel()
+                timed_out.add(futures[fut])
+                compress_timeouts += 1
+
+        def compressed_variant(it: MemoryItem) -> Optional[Tuple[str, int]]:
+            nonlocal compress_calls
+            key = compression_key(it)
+            hit = cache.get(key)
+            if hit is None:
+                if key in timed_out:
+                    return None
+                if key in prefetched:
+                    text = prefetched.pop(key)
                 else:
-                    stub = self._make_stub(it)
-                    if try_add(it.role, stub):
-                        stok = self.tc.count(stub)
-                        used_tokens += stok
-                        placeholder_tokens += stok
-                        stub_count += 1
-                        it.compression_state = Fidelity.PLACEHOLDER
-
-            else:  # PLACEHOLDER
-                stub = self._make_stub(it)
-                if try_add(it.role, stub):
-                    stok = self.tc.count(stub)
-                    used_tokens += stok
-                    placeholder_tokens += stok
-                    stub_count += 1
-                    it.compression_state = Fidelity.PLACEHOLDER
+                    compress_calls += 1
+                    text = self.compressor.compress(it.content, key[1], hint=current_query)
+                hit = (text, self.tc.count(text))
+                cache.put(key, *hit)
+            it.compressed_text = hit[0]
+            return hit
+
+        def record(idx: int, it: MemoryItem, fidelity: str, ntok: int) -> None:
+            nonlocal used_tokens, raw_tokens, compressed_tokens, placeholder_tokens
+            nonlocal expanded_count, compressed_count, stub_count
+            it.last_score = score_list[idx]  # stored items are only materialized here
+            used_tokens += ntok
+            if fidelity == Fidelity.FULL:
+                raw_tokens += ntok
+                expanded_count += 1
+            elif fidelity == Fidelity.COMPRESSED:
+                compressed_tokens += ntok
+                compressed_count += 1
+            else:
+                placeholder_tokens += ntok
+                stub_count += 1
+            it.compression_state = fidelity
+
+        # Compressors with a native compress_many handle a turn's compressions in one call
+        batched = type(self.compressor).compress_many is not Compressor.compress_many
+        parallel = self.cfg.compress_workers > 1 or batched
+
+        if self.cfg.packing == "priority":
+            # Pick variants by value per token on size estimates, realize them
+            # in the order picked (falling back when a real size does not
+            # fit), then emit chronologically
+            picks = self._pack_by_value(score_list, plan, budget_left)
+            chosen: Dict[int, Tuple[str, str, int]] = {}
+            compressed_tried = set()
+            if parallel:
+                prefetch([self._items[idx] for idx, v in picks.items() if v == Fidelity.COMPRESSED])
+            for idx, picked in picks.items():
+                it = self._items[idx]
+                if budget_left <= 0:
+                    break
+                for fidelity in _FALLBACKS[picked]:
+                    if fidelity == Fidelity.FULL:
+                        text, need = it.content, self._full_len(it, budget_left)
+                    elif fidelity == Fidelity.COMPRESSED:
+                        key = compression_key(it)
+                        if key not in cache and key[1] > budget_left:
+                            continue  # even the target cannot fit; counted as avoided below
+                        compressed_tried.add(idx)
+                        variant = compressed_variant(it)
+                        if variant is None:
+                            continue
+                        text, need = variant
+                    else:
+                        text, need = self._stub_variant(it)
+                    if need <= budget_left:
+                        budget_left -= need
+                        chosen[idx] = (fidelity, text, need)
+                        break
+
+            # Compressible items the packing never compressed (left at a stub,
+            # dropped, or skipped above) are compressor calls avoided
+            compress_calls_avoided += sum(
+                1 for idx, desired in enumerate(plan)
+                if desired != Fidelity.PLACEHOLDER and idx not in compressed_tried
+                and chosen.get(idx, ("",))[0] != Fidelity.FULL
+            )
+
+            # Only chosen items are touched, so a store materializes no others
+            for idx in sorted(chosen):
+                it = self._items[idx]
+                fidelity, text, need = chosen[idx]
+                messages.append((it.role, text))
+                record(idx, it, fidelity, need)
+
+        else:
+            # Emit in chronological order; fidelity decided by relevance plan
+            if parallel:
+                prefetch([self._items[i] for i, desired in enumerate(plan) if desired == Fidelity.COMPRESSED])
+            for idx, desired in enumerate(plan):
+                if desired == Fidelity.PLACEHOLDER and budget_left <= 0:
+                    continue  # a stub never fits once the budget is spent
+                it = self._items[idx]
+                if desired == Fidelity.FULL:
+                    # Length check first so stored content is only loaded when emitted
+                    need = self._full_len(it, budget_left)
+                    if need <= budget_left and try_add(it.role, it.content, need):
+                        record(idx, it, Fidelity.FULL, need)
+                        continue
+                    # fallback to compressed
+                    desired = Fidelity.COMPRESSED
+
+                if desired == Fidelity.COMPRESSED:
+                    variant = compressed_variant(it)
+                    if variant is not None and try_add(it.role, *variant):
+                        record(idx, it, Fidelity.COMPRESSED, variant[1])
+                        continue
+
+                # fallback to stub (never fits once the budget is spent)
+                if budget_left <= 0:
+                    continue
+                stub, stok = self._stub_variant(it)
+                if try_add(it.role, stub, stok):
+                    record(idx, it, Fidelity.PLACEHOLDER, stok)
 
         stats = {
             "budget": float(budget_tokens),
             "used": float(used_tokens),
+            "budget_utilization": float(budget_tokens - budget_left) / max(1, budget_tokens),
             "raw_tokens": float(raw_tokens),
             "compressed_tokens": float(compressed_tokens),
             "placeholder_tokens": float(placeholder_tokens),
             "expanded_count": float(expanded_count),
             "compressed_count": float(compressed_count),
             "stub_count": float(stub_count),
+            "compress_calls": float(compress_calls),
+            "compress_calls_avoided": float(compress_calls_avoided),
+            "compress_timeouts": float(compress_timeouts),
+            "compress_cache_hits": float(cache.hits - cache_hits),
+            "compress_cache_misses": float(cache.misses - cache_misses),
+            "compress_cache_entries": float(len(cache)),
             "items_total": float(len(self._items)),
-            "items_planned_full": float(sum(1 for _, it in scored if desired_map[it.id] == Fidelity.FULL)),
-            "items_planned_compressed": float(sum(1 for _, it in scored if desired_map[it.id] == Fidelity.COMPRESSED)),
-            "items_planned_stub": float(sum(1 for _, it in scored if desired_map[it.id] == Fidelity.PLACEHOLDER)),
+            "embeddings_joined": float(embeddings_joined),
+            "query_embed_calls": float(query_embed_calls),
+            "token_exact_counts": float(self._exact_counts - exact_before),
+            "items_scored": float(items_scored),
+            "items_planned_full": float(plan.count(Fidelity.FULL)),
+            "items_planned_compressed": float(plan.count(Fidelity.COMPRESSED)),
+            "items_planned_stub": float(plan.count(Fidelity.PLACEHOLDER)),
         }
 
         return messages, stats
 
+    def flush(self) -> None:
+        """Joins pending embeddings and flushes the store, if any."""
+        self.join_embeddings()
+        if hasattr(self._items, "flush"):
+            self._items.flush()
+
+    def close(self) -> None:
+        """Flushes, then shuts down the worker pools. The store is left open."""
+        try:
+            self.flush()
+        finally:
+            for pool in (self._pool, self._embed_pool):
+                if pool is not None:
+                    pool.shutdown(wait=True)
+            self._pool = self._embed_pool = None
+            self._pool_workers = 0
+
+    def rebuild_index(self) -> None:
+        """Retrains the ANN index on all rows; worthwhile once it reports `stale`."""
+        self.join_embeddings()
+        if self._ann is not None:
+            self._ann.rebuild()
+
+    def join_embeddings(self) -> int:
+        """
+        Waits for background embeddings and indexes them in item order.
+        A failed background call is retried inline. Returns the number joined.
+        """
+        if not self._pending:
+            return 0
+        joined = []
+        try:
+            while self._pending:
+                item, fut = self._pending[0]
+                try:
+                    emb = fut.result()
+                except Exception:
+                    emb = self.embedder.encode(item.content)
+                self._pending.popleft()
+                item.embedding = emb if self._keep_item_embeddings else None
+                joined.append(emb)
+        finally:
+            # Keep matrix rows aligned with items even if a retry raises
+            if joined:
+                self._index_embeddings(joined)
+        return len(joined)
+
     # ---- Internals ----
 
+    def _score_items(self, q_emb: List[float]):
+        """
+        Relevance * recency score for every item, in item order.
+        Returns (scores, items_scored); with the ANN index only the top-K
+        candidates and the recent window are scored, the rest score 0.
+        """
+        n = len(self._items)
+        if self._ann is not None:
+            return self._score_candidates(q_emb)
+        if np is not None and self._matrix.vectorized:
+            return self._score_vectorized(q_emb), n
+        return self._score_python(q_emb), n
+
+    def _index_embeddings(self, embeddings: List[List[float]]) -> None:
+        """Appends new item embeddings to the matrix and its side indexes."""
+        rows = self._matrix.extend(embeddings)
+        if self._ann is not None:
+            for row, emb in zip(rows, embeddings):
+                self._ann.add(row, emb)
+        if self._coarse is not None:
+            block = np.asarray([list(e) for e in embeddings], dtype=np.float32)
+            if block.shape[1] <= self.cfg.coarse_dims:
+                # Dimension learned from the first rows
+                self._coarse = None
+                return
+            self._coarse.extend(_prefix(block, self.cfg.coarse_dims))
+
+    def _recency_factor(self, turns_ago):
+        half = max(1, self.cfg.recency_half_life)
+        return 0.25 + 0.75 * np.power(0.5, turns_ago / half)
+
+    def _score_vectorized(self, q_emb: List[float]):
+        n = len(self._items)
+        turns_ago = np.arange(n - 1, -1, -1, dtype=np.float64)
+        recency = self._recency_factor(turns_ago)
+        if self._coarse is None:
+            return np.maximum(self._matrix.scores(q_emb), 0.0) * recency
+
+        # Coarse pass on the prefix, full-dim rescoring only near thresholds
+        q_coarse = _prefix(np.asarray([q_emb], dtype=np.float32), self.cfg.coarse_dims)[0]
+        scores = np.maximum(self._coarse.scores(q_coarse), 0.0) * recency
+        margin = self.cfg.coarse_margin
+        near = ((np.abs(scores - self.cfg.high_threshold) <= margin)
+                | (np.abs(scores - self.cfg.mid_threshold) <= margin))
+        rows = np.flatnonzero(near)
+        if len(rows):
+            scores[rows] = np.maximum(self._matrix.scores_for(rows, q_emb), 0.0) * recency[rows]
+        return scores
+
+    def _score_candidates(self, q_emb: List[float]):
+        n = len(self._items)
+        recent = range(max(0, n - self.cfg.ann_recent_window), n)
+        rows = np.unique(np.fromiter(
+            list(self._ann.search(q_emb, self.cfg.ann_top_k)) + list(recent),
+            dtype=np.int64,
+        ))
+        scores = np.zeros(n, dtype=np.float64)
+        if len(rows):
+            sims = self._matrix.scores_for(rows, q_emb)
+            scores[rows] = np.maximum(sims, 0.0) * self._recency_factor((n - 1 - rows).astype(np.float64))
+        return scores, len(rows)
+
+    def _score_python(self, q_emb: List[float]) -> List[float]:
+        n = len(self._items)
+        scores: List[float] = []
+        for idx, it in enumerate(self._items):
+            if not it.embedding:
+                it.embedding = self.embedder.encode(it.content)
+                self._matrix.set(idx, it.embedding)
+            sim = cosine(q_emb, it.embedding)
+            turns_ago = (n - 1) - idx
+            half = max(1, self.cfg.recency_half_life)
+            recency_weight = 0.5 ** (turns_ago / half)
+            scores.append(max(0.0, sim) * (0.25 + 0.75 * recency_weight))
+        return scores
+
+    def _plan_fidelity(self, scores) -> List[str]:
+        """Buckets scores into PLACEHOLDER / COMPRESSED / FULL by thresholds."""
+        thresholds = [self.cfg.mid_threshold, self.cfg.high_threshold]
+        if np is not None and not isinstance(scores, list):
+            bands = np.searchsorted(np.asarray(thresholds), scores, side="right")
+            return [_FIDELITY_BANDS[b] for b in bands.tolist()]
+        plan: List[str] = []
+        for score in scores:
+            if score >= self.cfg.high_threshold:
+                plan.append(Fidelity.FULL)
+            elif score >= self.cfg.mid_threshold:
+                plan.append(Fidelity.COMPRESSED)
+            else:
+                plan.append(Fidelity.PLACEHOLDER)
+        return plan
+
+    def _compress_pool(self) -> ThreadPoolExecutor:
+        workers = max(1, self.cfg.compress_workers)
+        if self._pool is None or self._pool_workers != workers:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="afm-compress")
+            self._pool_workers = workers
+        return self._pool
+
+    def _remember(self, digest: str, emb) -> None:
+        if self.cfg.embedding_memo_size <= 0:
+            return
+        self._memo[digest] = emb
+        self._memo.move_to_end(digest)
+        while len(self._memo) > self.cfg.embedding_memo_size:
+            self._memo.popitem(last=False)
+
+    def _query_embedding(self, text: str) -> Tuple[List[float], int]:
+        """Embedding of `text` from the memo when recent, else encoded. Returns (vec, encode calls)."""
+        digest = content_hash(text)
+        emb = self._memo.get(digest)
+        if isinstance(emb, Future):
+            try:
+                emb = emb.result()
+            except Exception:
+                emb = None
+        if emb is not None:
+            self._memo.move_to_end(digest)
+            return emb, 0
+        emb = self.embedder.encode(text)
+        self._remember(digest, emb)
+        return emb, 1
+
+    def _item_embedding(self, item_id: int) -> Tuple[MemoryItem, List[float]]:
+        """Looks up an item by id (newest first) and returns it with its vector."""
+        for idx in range(len(self._items) - 1, -1, -1):
+            it = self._items[idx]
+            if it.id == item_id:
+                if it.embedding is not None:
+                    return it, it.embedding
+                if isinstance(self._matrix, EmbeddingMatrix) and np is not None:
+                    return it, self._matrix.rows(np.asarray([idx]))[0]
+                return it, self.embedder.encode(it.content)
+        raise KeyError(f"No item with id {item_id}")
+
+    def _embedding_pool(self) -> ThreadPoolExecutor:
+        if self._embed_pool is None:
+            self._embed_pool = ThreadPoolExecutor(max_workers=self.cfg.embed_workers,
+                                                  thread_name_prefix="afm-embed")
+        return self._embed_pool
+
+    def _new_item(self, role: str, content: str, token_len: Optional[int] = None) -> MemoryItem:
+        """Next item with its id, content hash and token length; `token_len` is a precomputed count."""
+        item = MemoryItem(id=self._next_id, role=role, content=content)
+        self._next_id += 1
+        self._set_token_len(item, token_len)
+        item.content_hash = content_hash(content)
+        return item
+
+    def _set_token_len(self, it: MemoryItem, count: Optional[int] = None) -> None:
+        if self.cfg.keep_token_ids:
+            ids = self.tc.encode(it.content)
+            if ids is not None:
+                # One encode gives the exact length, the stub prefix and sentence counts
+                ends = self.tc.sentence_ends(it.content, ids)
+                it.token_ids, it.sentence_ends, it.token_len = ids, ends, len(ids)
+                self.compressor.prepare(it.content, [b - a for a, b in zip([0, *ends[:-1]], ends)])
+                return
+        if self.cfg.prepare_compression:
+            self.compressor.prepare(it.content)
+        if count is not None or not self.cfg.estimate_tokens:
+            it.token_len = self.tc.count(it.content) if count is None else count
+            return
+        _, lo, hi = self.tc.estimate(it.content)
+        it.token_len, it.token_lo, it.token_exact = hi, lo, lo == hi
+
+    def _full_len(self, it: MemoryItem, budget_left: int) -> int:
+        """
+        Tokens charged for emitting `it` in full. Estimated items are counted
+        exactly here, since the estimate is no hard bound; only items whose
+        low estimate already exceeds `budget_left` skip the count.
+        """
+        if it.token_exact or it.token_lo > budget_left:
+            return it.token_len
+        return self._exact_len(it)
+
+    def _exact_len(self, it: MemoryItem) -> int:
+        """Exact token length of `it`, replacing its estimate on first use."""
+        if not it.token_exact:
+            it.token_len = self.tc.count(it.content)
+            it.token_exact, it.token_lo = True, it.token_len
+            self._exact_counts += 1
+        return it.token_len
+
+    def _pack_by_value(self, scores: List[float], plan: List[str], budget: int) -> Dict[int, str]:
+        """
+        Variant per item for priority packing, as a greedy multiple-choice
+        knapsack on estimated sizes (stub budget, compression target, token
+        length). Every item climbs from a stub toward its planned fidelity
+        one step at a time; steps are taken best added value (score times
+        _VARIANT_VALUE) per added token first, while they fit. Returns
+        idx -> variant in the order items were first picked.
+        """
+        def size(it: Optional[MemoryItem], fidelity: str) -> int:
+            if fidelity == Fidelity.FULL:
+                return it.token_len
+            if fidelity == Fidelity.COMPRESSED:
+                return self._compress_target(it)
+            return max(1, self.cfg.max_placeholder_tokens)
+
+        stub = size(None, Fidelity.PLACEHOLDER)
+        stub_value = _VARIANT_VALUE[Fidelity.PLACEHOLDER]
+        # (-value per token, -idx, idx, step); ties favour recent items
+        heap = [(-score * stub_value / stub, -idx, idx, 0) for idx, score in enumerate(scores)]
+        heapq.heapify(heap)
+        picks: Dict[int, str] = {}
+        while heap and budget > 0:
+            _, _, idx, step = heapq.heappop(heap)
+            ladder = _FALLBACKS[plan[idx]][::-1]
+            it = self._items[idx] if step else None
+            cost = size(it, ladder[step]) - (size(it, ladder[step - 1]) if step else 0)
+            if cost > budget:
+                continue
+            budget -= cost
+            picks[idx] = ladder[step]
+            if step + 1 < len(ladder):
+                it = self._items[idx]
+                gain = scores[idx] * (_VARIANT_VALUE[ladder[step + 1]] - _VARIANT_VALUE[ladder[step]])
+                extra = size(it, ladder[step + 1]) - size(it, ladder[step])
+                density = gain / extra if extra > 0 else float("inf")
+                heapq.heappush(heap, (-density, -idx, idx, step + 1))
+        return picks
+
+    def _compress_target(self, it: MemoryItem) -> int:
+        # From the exact length, so the target (and cache key) does not move
+        # once an estimate is replaced; the compressor encodes the text anyway
+        return max(1, int(self._exact_len(it) * self.cfg.default_compress_ratio))
+
+    def _stub_variant(self, it: MemoryItem) -> Tuple[str, int]:
+        """Stub text and its token length, cached on the item."""
+        if it.stub_text is None or it.stub_budget != self.cfg.max_placeholder_tokens:
+            it.stub_text = self._make_stub(it)
+            it.stub_len = self.tc.count(it.stub_text)
+            it.stub_budget = self.cfg.max_placeholder_tokens
+            # A store keeps the stub with the item's record
+            save = getattr(self._items, "save_stub", None)
+            if save is not None:
+                save(it)
+        return it.stub_text, it.stub_len
+
     def _make_stub(self, it: MemoryItem) -> str:
         head = it.content.strip().split("\n", 1)[0][:200]
         prefix = f"[ref #{it.id} • {it.role}] "
         room = max(0, self.cfg.max_placeholder_tokens - self.tc.count(prefix))
         if room <= 0:
             return prefix.strip()
-        snippet = truncate_to_tokens(head, room, self.tc)
+        # Token ids of the content also cover `head` when it is a prefix of it
+        ids = it.token_ids if it.token_ids is not None and it.content.startswith(head) else None
+        snippet = self.tc.truncate(head, room, ids=ids)
         return prefix + snippet
 
     def items(self) -> List[MemoryItem]:
@@ -0,0 +1,263 @@
+# item_store.py
+from __future__ import annotations
+
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator, Optional
+
+try:
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+from embedding_matrix import EmbeddingMatrix
+from focus import MemoryItem
+
+_VERSION = 1
+_HEADER = "header.json"
+_META = "meta.bin"
+_EMB = "embeddings.f32"
+_BLOB = "content.blob"
+_STUBS = "stubs.bin"
+
+if np is not None:
+    # One fixed-width record per item; unused capacity rows have id == 0
+    _META_DTYPE = np.dtype([
+        ("id", "<i8"),
+        ("role", "S16"),
+        ("created_at_s", "<f8"),
+        ("token_len", "<i4"),
+        ("length", "<i4"),
+        ("offset", "<i8"),
+    ])
+    # Row-aligned stub cache; budget == 0 means no stub stored
+    _STUB_DTYPE = np.dtype([
+        ("budget", "<i4"),
+        ("length", "<i4"),
+        ("text", "S192"),
+    ])
+
+def _map(path: str, dtype, rows: int, cols: Optional[int] = None):
+    """Memory-maps `rows` records of `path`, extending the file if needed."""
+    shape = (rows,) if cols is None else (rows, cols)
+    need = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(path, "ab") as f:
+        if f.tell() < need:
+            f.truncate(need)
+    return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+class _MappedMatrix(EmbeddingMatrix):
+    """EmbeddingMatrix whose float32 buffer is a memory-mapped file."""
+    def __init__(self, path: str, dim: Optional[int], rows: int, chunk_rows: int,
+                 on_allocate: Optional[Callable[[], None]] = None):
+        super().__init__(dim=dim, chunk_rows=chunk_rows)
+        self.path = path
+        self._on_allocate = on_allocate
+        if dim and os.path.exists(path):
+            cap = os.path.getsize(path) // (4 * dim)
+            if cap:
+                self._buf = _map(path, np.float32, cap, dim)
+        self._n = rows
+
+    def _allocate(self, capacity: int):
+        buf = _map(self.path, np.float32, capacity, self.dim)
+        if self._on_allocate is not None:
+            # The file is only readable with its dim, so record it right away
+            self._on_allocate()
+        return buf
+
+    def _grow(self, capacity: int):
+        self._buf.flush()
+        return self._allocate(capacity)
+
+    def flush(self) -> None:
+        if self._buf is not None:
+            self._buf.flush()
+
+class _StoredItem(MemoryItem):
+    """MemoryItem whose content is read from the blob file on first access."""
+    _store: "MmapItemStore"
+    _row: int
+    _content: Optional[str] = None
+
+    @property
+    def content(self) -> str:
+        if self._content is None:
+            self._content = self._store._read_content(self._row)
+        return self._content
+
+    @content.setter
+    def content(self, value: Optional[str]) -> None:
+        self._content = value
+
+class MmapItemStore:
+    """
+    Persistent FocusManager storage in a directory:
+    - meta.bin:       fixed-width item records (memory-mapped)
+    - embeddings.f32: (n, dim) float32 rows (memory-mapped)
+    - content.blob:   append-only UTF-8 content
+    - stubs.bin:      placeholder text and token length per row (memory-mapped)
+    Behaves like the in-RAM item list (len/index/iterate/append/extend) and
+    exposes `matrix` for scoring. Reopening maps the files without reading
+    content or re-embedding; content is loaded when an item is emitted.
+    At most `cache_items` materialized items (with their content and
+    cached stubs) are kept, least recently used first out; an evicted item
+    is rebuilt from its record on next access, stub included, so emitting
+    a placeholder never rereads content. Requires numpy.
+    """
+    def __init__(self, path: str, dim: Optional[int] = None, chunk_rows: int = 4096,
+                 cache_items: int = 4096):
+        if np is None:
+            raise RuntimeError("MmapItemStore requires numpy.")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_rows = max(1, chunk_rows)
+        self.cache_items = max(1, cache_items)
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[int, MemoryItem]" = OrderedDict()
+
+        header_path = os.path.join(path, _HEADER)
+        if os.path.exists(header_path):
+            with open(header_path, "r", encoding="utf-8") as f:
+                header = json.load(f)
+            if header.get("version") != _VERSION:
+                raise ValueError(f"Unsupported item store version: {header.get('version')}")
+            dim = header.get("dim") or dim
+        self._dim = dim
+
+        meta_path = os.path.join(path, _META)
+        cap = max(self.chunk_rows, os.path.getsize(meta_path) // _META_DTYPE.itemsize
+                  if os.path.exists(meta_path) else 0)
+        self._meta = _map(meta_path, _META_DTYPE, cap)
+        self._stubs = _map(os.path.join(path, _STUBS), _STUB_DTYPE, cap)
+        self._n = int(np.count_nonzero(self._meta["id"]))
+        self._blob = open(os.path.join(path, _BLOB), "a+b")
+        self.matrix = _MappedMatrix(os.path.join(path, _EMB), dim, self._n, self.chunk_rows,
+                                    on_allocate=self._sync_header)
+        self._write_header()
+
+    # ---- Sequence API (mirrors the in-RAM list) ----
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __getitem__(self, idx: int) -> MemoryItem:
+        if idx < 0:
+            idx += self._n
+        if not 0 <= idx < self._n:
+            raise IndexError(idx)
+        item = self._cache.get(idx)
+        if item is not None:
+            self._cache.move_to_end(idx)
+        else:
+            # One tuple per record: field-by-field access on a memmap row is slow
+            item_id, role, created_at_s, token_len = self._meta[idx].item()[:4]
+            item = _StoredItem(
+                id=item_id,
+                role=role.decode("utf-8"),
+                content=None,
+                created_at_s=created_at_s,
+                token_len=abs(token_len),
+                token_exact=token_len >= 0,
+            )
+            item._store, item._row = self, idx
+            stub_budget, stub_len, stub_text = self._stubs[idx].item()
+            if stub_budget > 0:
+                item.stub_text = stub_text.decode("utf-8")
+                item.stub_len, item.stub_budget = stub_len, stub_budget
+            self._remember(idx, item)
+        return item
+
+    def __iter__(self) -> Iterator[MemoryItem]:
+        for idx in range(self._n):
+            yield self[idx]
+
+    def append(self, item: MemoryItem) -> None:
+        self.extend([item])
+
+    def extend(self, items: Iterable[MemoryItem]) -> None:
+        items = list(items)
+        if not items:
+            return
+        with self._lock:
+            if self._n + len(items) > len(self._meta):
+                self._meta.flush()
+                cap = max(self._n + len(items), len(self._meta) + max(self.chunk_rows, len(self._meta) // 2))
+                self._meta = _map(os.path.join(self.path, _META), _META_DTYPE, cap)
+                self._stubs.flush()
+                self._stubs = _map(os.path.join(self.path, _STUBS), _STUB_DTYPE, cap)
+            self._blob.seek(0, os.SEEK_END)
+            offset = self._blob.tell()
+            payloads = [it.content.encode("utf-8") for it in items]
+            self._blob.write(b"".join(payloads))
+            self._blob.flush()
+            for it, data in zip(items, payloads):
+                rec = self._meta[self._n]
+                rec["role"] = it.role.encode("utf-8")[:16]
+                rec["created_at_s"] = it.created_at_s
+                # Negative: an estimator upper bound, not an exact count
+                rec["token_len"] = it.token_len if it.token_exact else -it.token_len
+                rec["length"] = len(data)
+                rec["offset"] = offset
+                rec["id"] = it.id  # written last: a non-zero id marks the record valid
+                offset += len(data)
+                it._row = self._n  # lets save_stub find the record
+                self._remember(self._n, it)
+                self._n += 1
+        self._sync_header()
+
+    # ---- Store API ----
+
+    @property
+    def next_id(self) -> int:
+        return int(self._meta["id"][self._n - 1]) + 1 if self._n else 1
+
+    def save_stub(self, item: MemoryItem) -> None:
+        """Persists `item`'s cached stub in its row (skipped if too long for the record)."""
+        row = getattr(item, "_row", None)
+        if row is None or item.stub_text is None:
+            return
+        data = item.stub_text.encode("utf-8")
+        if len(data) > _STUB_DTYPE["text"].itemsize or data.endswith(b"\0"):
+            return
+        rec = self._stubs[row]
+        rec["text"], rec["length"], rec["budget"] = data, item.stub_len, item.stub_budget
+
+    def flush(self) -> None:
+        self._meta.flush()
+        self._stubs.flush()
+        self.matrix.flush()
+        self._blob.flush()
+        self._sync_header()
+
+    def close(self) -> None:
+        self.flush()
+        self._blob.close()
+
+    # ---- Internals ----
+
+    def _remember(self, idx: int, item: MemoryItem) -> None:
+        self._cache[idx] = item
+        if len(self._cache) > self.cache_items:
+            self._cache.popitem(last=False)
+
+    def _read_content(self, idx: int) -> str:
+        rec = self._meta[idx]
+        with self._lock:
+            self._blob.seek(int(rec["offset"]))
+            data = self._blob.read(int(rec["length"]))
+        return data.decode("utf-8")
+
+    def _sync_header(self) -> None:
+        # The matrix learns its dim from the first embedding
+        if self._dim is None and self.matrix.dim:
+            self._dim = self.matrix.dim
+            self._write_header()
+
+    def _write_header(self) -> None:
+        tmp = os.path.join(self.path, _HEADER + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": _VERSION, "dim": self._dim}, f)
+        os.replace(tmp, os.path.join(self.path, _HEADER))
@@ -1,11 +1,12 @@
 # llm_compressor.py
+import asyncio
 import os
 from typing import Optional
 from compression import Compressor
 from token_counter import TokenCounter
 
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI, OpenAI
     _OPENAI_V1 = True
 except ImportError:
     import openai
@@ -17,10 +18,23 @@ _SYSTEM = (
 )
 
 class LLMCompressor(Compressor):
-    """LLM-backed compressor that targets an approximate token budget."""
-    def __init__(self, token_counter: TokenCounter, model: str = "gpt-4o-mini"):
+    """
+    LLM-backed compressor that targets an approximate token budget.
+    acompress uses one AsyncOpenAI client (pass `async_client` to share its
+    connection pool) with at most `max_concurrency` requests in flight.
+    """
+    def __init__(
+        self,
+        token_counter: TokenCounter,
+        model: str = "gpt-4o-mini",
+        max_concurrency: int = 16,
+        async_client=None,
+    ):
         super().__init__(token_counter)
         self.model = model
+        self.max_concurrency = max(1, max_concurrency)
+        self._async_client = async_client
+        self._sem: Optional[asyncio.Semaphore] = None
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY not set.")
@@ -34,26 +48,41 @@ class LLMCompressor(Compressor):
         if self.tc.count(text) <= target_tokens:
             return text
 
-        prompt = (
-            f"Target token budget: ~{target_tokens} tokens.\n"
-            f"Compression hint: {hint or 'N/A'}\n\n{text}"
-        )
-
+        messages = self._messages(text, target_tokens, hint)
         if _OPENAI_V1:
             out = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "system", "content": _SYSTEM},
-                          {"role": "user", "content": prompt}],
-                temperature=0.2,
+                model=self.model, messages=messages, temperature=0.2,
             )
-            comp = out.choices[0].message.content.strip()
-        else:
-            out = openai.ChatCompletion.create(
-                model=self.model,
-                messages=[{"role": "system", "content": _SYSTEM},
-                          {"role": "user", "content": prompt}],
-                temperature=0.2,
+            return out.choices[0].message.content.strip()
+        out = openai.ChatCompletion.create(
+            model=self.model, messages=messages, temperature=0.2,
+        )
+        return out["choices"][0]["message"]["content"].strip()
+
+    async def acompress(self, text: str, target_tokens: int, hint: Optional[str] = None) -> str:
+        if self.tc.count(text) <= target_tokens:
+            return text
+
+        messages = self._messages(text, target_tokens, hint)
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        async with self._sem:
+            if _OPENAI_V1:
+                if self._async_client is None:
+                    self._async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+                out = await self._async_client.chat.completions.create(
+                    model=self.model, messages=messages, temperature=0.2,
+                )
+                return out.choices[0].message.content.strip()
+            out = await openai.ChatCompletion.acreate(
+                model=self.model, messages=messages, temperature=0.2,
             )
-            comp = out["choices"][0]["message"]["content"].strip()
+        return out["choices"][0]["message"]["content"].strip()
 
-        return comp
+    def _messages(self, text: str, target_tokens: int, hint: Optional[str]):
+        prompt = (
+            f"Target token budget: ~{target_tokens} tokens.\n"
+            f"Compression hint: {hint or 'N/A'}\n\n{text}"
+        )
+        return [{"role": "system", "content": _SYSTEM},
+                {"role": "user", "content": prompt}]
@@ -1,20 +1,50 @@
 # openai_embedder.py
+import asyncio
 import os
-from typing import List
+from typing import List, Optional, Sequence
 from embedding import Embedder
+from token_counter import TokenCounter
 from utils import l2_normalize_inplace
 
 try:
-    from openai import OpenAI
+    import numpy as np  # type: ignore
+except Exception:  # pragma: no cover
+    np = None
+
+try:
+    from openai import AsyncOpenAI, OpenAI
     _OPENAI_V1 = True
 except ImportError:
     import openai
     _OPENAI_V1 = False
 
 class OpenAIEmbedder(Embedder):
-    """OpenAI embeddings with L2-normalization."""
-    def __init__(self, model: str = "text-embedding-3-small"):
+    """
+    OpenAI embeddings with L2-normalization.
+    encode_many batches inputs into as few requests as possible, bounded by
+    `max_batch_size` inputs and `max_batch_tokens` tokens per request.
+    `dimensions` requests shortened vectors (text-embedding-3 models only).
+    aencode/aencode_many use one AsyncOpenAI client (pass `async_client` to
+    share its connection pool) with at most `max_concurrency` requests in
+    flight; the client and limit are bound to the first event loop using them.
+    """
+    def __init__(
+        self,
+        model: str = "text-embedding-3-small",
+        dimensions: Optional[int] = None,
+        max_batch_size: int = 512,
+        max_batch_tokens: int = 200_000,
+        token_counter: Optional[TokenCounter] = None,
+        max_concurrency: int = 16,
+        async_client=None,
+    ):
         self.model = model
+        self.dimensions = dimensions
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_tokens = max(1, max_batch_tokens)
+        self.max_concurrency = max(1, max_concurrency)
+        self._async_client = async_client
+        self._sem: Optional[asyncio.Semaphore] = None
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY not set.")
@@ -23,15 +53,86 @@ class OpenAIEmbedder(Embedder):
         else:
             openai.api_key = api_key
             self.client = None
-        self.dim = 1536
+        self.tc = token_counter or TokenCounter(model)
+        self.dim = dimensions or 1536
 
     def encode(self, text: str) -> List[float]:
         if _OPENAI_V1:
-            out = self.client.embeddings.create(model=self.model, input=text)
+            out = self.client.embeddings.create(model=self.model, input=text, **self._extra())
             vec = list(out.data[0].embedding)
         else:
-            out = openai.Embedding.create(model=self.model, input=text)
+            out = openai.Embedding.create(model=self.model, input=text, **self._extra())
             vec = list(out["data"][0]["embedding"])
         self.dim = len(vec)
         l2_normalize_inplace(vec)
         return vec
+
+    def encode_many(self, texts: Sequence[str]) -> List[List[float]]:
+        out: List[List[float]] = []
+        for batch in self._batches(texts):
+            out.extend(self._request(batch))
+        return out
+
+    async def aencode(self, text: str) -> List[float]:
+        return (await self.aencode_many([text]))[0]
+
+    async def aencode_many(self, texts: Sequence[str]) -> List[List[float]]:
+        parts = await asyncio.gather(*(self._arequest(b) for b in self._batches(texts)))
+        return [vec for part in parts for vec in part]
+
+    # ---- Internals ----
+
+    def _extra(self) -> dict:
+        return {"dimensions": self.dimensions} if self.dimensions else {}
+
+    def _batches(self, texts: Sequence[str]):
+        """Splits texts into consecutive batches by input count and token total."""
+        batch: List[str] = []
+        batch_tokens = 0
+        for text, ntok in zip(texts, self.tc.count_many(texts)):
+            if batch and (len(batch) >= self.max_batch_size
+                          or batch_tokens + ntok > self.max_batch_tokens):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += ntok
+        if batch:
+            yield batch
+
+    def _request(self, batch: List[str]) -> List[List[float]]:
+        if _OPENAI_V1:
+            out = self.client.embeddings.create(model=self.model, input=batch, **self._extra())
+        else:
+            out = openai.Embedding.create(model=self.model, input=batch, **self._extra())
+        return self._parse(out)
+
+    async def _arequest(self, batch: List[str]) -> List[List[float]]:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        async with self._sem:
+            if _OPENAI_V1:
+                if self._async_client is None:
+                    self._async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+                out = await self._async_client.embeddings.create(
+                    model=self.model, input=batch, **self._extra())
+            else:
+                out = await openai.Embedding.acreate(model=self.model, input=batch, **self._extra())
+        return self._parse(out)
+
+    def _parse(self, out) -> List[List[float]]:
+        if _OPENAI_V1:
+            rows = sorted(out.data, key=lambda d: d.index)
+            vecs = [list(d.embedding) for d in rows]
+        else:
+            rows = sorted(out["data"], key=lambda d: d["index"])
+            vecs = [list(d["embedding"]) for d in rows]
+        if vecs:
+            self.dim = len(vecs[0])
+        if np is not None:
+            arr = np.asarray(vecs, dtype=np.float64)
+            norms = np.linalg.norm(arr, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            return (arr / norms).tolist()
+        for vec in vecs:
+            l2_normalize_inplace(vec)
+        return vecs
@@ -0,0 +1,32 @@
+# tests/test_compression.py
+import pytest
+
+import compression
+from compression import HeuristicCompressor
+from token_counter import TokenCounter
+
+TEXTS = [
+    f"Item {i} is about topic {i % 4}. The weather in city {i % 3} was mild. "
+    f"We booked a table for dinner {i}. Nothing else happened on day {i}!"
+    for i in range(30)
+] + ["", "No sentence boundary here just words about topic 1 and city 2", "Short one."]
+HINTS = [None, "", "topic 1 weather", "dinner table city 2", "unrelated words only"]
+
+def _reference(text, target, hint):
+    return HeuristicCompressor(TokenCounter("gpt-4o-mini")).compress(text, target, hint)
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+@pytest.mark.parametrize("max_analyses", [4096, 5, 0])
+def test_compress_many_matches_compress(monkeypatch, use_numpy, max_analyses):
+    if not use_numpy:
+        monkeypatch.setattr(compression, "np", None)
+    elif compression.np is None:
+        pytest.skip("numpy is not installed")
+    comp = HeuristicCompressor(TokenCounter("gpt-4o-mini"), max_analyses=max_analyses)
+    for text in TEXTS[::3]:
+        comp.prepare(text)  # some texts indexed (and maybe evicted) before the batch
+    requests = [(text, 4 + i % 9) for i, text in enumerate(TEXTS + TEXTS[:5])]
+    for hint in HINTS:
+        got = comp.compress_many(requests, hint)
+        assert got == [_reference(text, target, hint) for text, target in requests]
+        assert got == [comp.compress(text, target, hint) for text, target in requests]
@@ -0,0 +1,39 @@
+# tests/test_embedding.py
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from embedding import HashingEmbedder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEXTS = ["alpha beta gamma delta epsilon", "Seattle coffee crawl and indie bookstores.", ""]
+
+def _encode_in_subprocess(seed: str):
+    code = ("import json, sys; from embedding import HashingEmbedder; "
+            "print(json.dumps(HashingEmbedder(dim=64, stable=True).encode_many(json.loads(sys.argv[1]))))")
+    env = dict(os.environ, PYTHONHASHSEED=seed)
+    out = subprocess.run([sys.executable, "-c", code, json.dumps(TEXTS)], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+def test_stable_vectors_match_across_processes():
+    here = HashingEmbedder(dim=64, stable=True).encode_many(TEXTS)
+    assert _encode_in_subprocess("1") == _encode_in_subprocess("2") == here
+
+def test_memo_overflow_within_one_call():
+    text = "alpha beta gamma delta epsilon zeta eta theta"
+    small = HashingEmbedder(dim=64, stable=True, memo_size=4)
+    ref = HashingEmbedder(dim=64, stable=True).encode(text)
+    assert small.encode(text) == ref
+    assert small.encode_many([text, text]) == [ref, ref]
+    assert len(small._memo) <= 4
+
+def test_memo_shared_across_threads():
+    emb = HashingEmbedder(dim=64, stable=True, memo_size=16)
+    texts = [" ".join(f"w{(i * 7 + j) % 97}" for j in range(30)) for i in range(200)]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        got = list(pool.map(emb.encode, texts))
+    ref = HashingEmbedder(dim=64, stable=True)
+    assert got == [ref.encode(t) for t in texts]
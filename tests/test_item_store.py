@@ -0,0 +1,63 @@
+# tests/test_item_store.py
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from embedding import HashingEmbedder
+from focus import FocusConfig, FocusManager
+from item_store import MmapItemStore
+from token_counter import TokenCounter
+
+MESSAGES = [
+    ("user" if i % 2 == 0 else "assistant", f"Message {i} about topic {i % 5}. Some more words here.")
+    for i in range(40)
+]
+
+def _manager(store, **cfg) -> FocusManager:
+    config = FocusConfig(**{"high_threshold": 0.5, "mid_threshold": 0.2, **cfg})
+    return FocusManager(HashingEmbedder(dim=32, stable=True), TokenCounter("gpt-4o-mini"),
+                        config=config, store=store)
+
+def _snapshot(fm: FocusManager):
+    return [(it.id, it.role, it.content, it.token_len) for it in fm.items()]
+
+def test_round_trip_matches_in_memory(tmp_path):
+    ref = _manager(None)
+    ref.add_messages(MESSAGES)
+    store = MmapItemStore(str(tmp_path), cache_items=8)
+    fm = _manager(store)
+    fm.add_messages(MESSAGES[:20])
+    for role, content in MESSAGES[20:]:
+        fm.add_message(role, content)
+    store.close()
+
+    reopened = _manager(MmapItemStore(str(tmp_path), cache_items=8))
+    assert _snapshot(reopened) == _snapshot(ref)
+    for query in ("topic 3", "Message 39"):
+        assert reopened.build_context(query, 200)[0] == ref.build_context(query, 200)[0]
+
+def test_reopen_without_close(tmp_path):
+    fm = _manager(MmapItemStore(str(tmp_path)))
+    fm.add_message("user", "Seattle coffee crawl")
+    # No close()/flush(): the header must already record the embedding dim
+    reopened = _manager(MmapItemStore(str(tmp_path)))
+    assert reopened._matrix.dim == 32
+    msgs, stats = reopened.build_context("Seattle coffee crawl", 50)
+    assert msgs == [("user", "Seattle coffee crawl")]
+    assert reopened.add_message("assistant", "Sure.").id == 2
+
+def test_stubs_survive_eviction_and_reopen(tmp_path, monkeypatch):
+    stubs_only = {"high_threshold": 2.0, "mid_threshold": 2.0}
+    store = MmapItemStore(str(tmp_path), cache_items=4)
+    fm = _manager(store, **stubs_only)
+    fm.add_messages(MESSAGES)
+    first = fm.build_context("unrelated query", 10_000)[0]
+    store.close()
+
+    reads = []
+    store = MmapItemStore(str(tmp_path), cache_items=4)
+    monkeypatch.setattr(store, "_read_content", lambda idx: reads.append(idx) or "")
+    reopened = _manager(store, **stubs_only)
+    msgs = reopened.build_context("unrelated query", 10_000)[0]
+    assert reads == []
+    assert msgs == first and len(msgs) == len(MESSAGES)
@@ -0,0 +1,63 @@
+# tests/test_parallel_compression.py
+import threading
+import time
+
+from compression import Compressor
+from embedding import HashingEmbedder
+from focus import FocusConfig, FocusManager
+from token_counter import TokenCounter
+
+MESSAGES = [
+    ("user" if i % 2 == 0 else "assistant",
+     f"Message {i} covers topic {i % 3}. It has a second sentence. And a third one about item {i}.")
+    for i in range(8)
+]
+
+class SlowCompressor(Compressor):
+    """Keeps the first `target_tokens` words after waiting `delay_s` (or until released)."""
+    def __init__(self, delay_s: float = 0.0):
+        self.delay_s = delay_s
+        self.release = threading.Event()
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def compress(self, text: str, target_tokens: int, hint=None) -> str:
+        with self._lock:
+            self.calls += 1
+        self.release.wait(self.delay_s)
+        return " ".join(text.split()[:target_tokens])
+
+def _manager(compressor: Compressor, **cfg) -> FocusManager:
+    tc = TokenCounter("gpt-4o-mini")
+    # mid_threshold 0 and an unreachable high_threshold plan every item COMPRESSED
+    config = FocusConfig(high_threshold=2.0, mid_threshold=0.0, **cfg)
+    fm = FocusManager(HashingEmbedder(dim=64, stable=True), tc, compressor, config)
+    for role, content in MESSAGES:
+        fm.add_message(role, content)
+    return fm
+
+def test_parallel_matches_sequential():
+    results = []
+    for workers in (1, 4):
+        fm = _manager(SlowCompressor(delay_s=0.01), compress_workers=workers)
+        msgs, stats = fm.build_context("topic 1", budget_tokens=400)
+        fm.close()
+        results.append((msgs, {k: stats[k] for k in ("used", "compressed_count", "stub_count")}))
+    assert results[0] == results[1]
+    assert results[0][1]["compressed_count"] == len(MESSAGES)
+
+def test_timeout_is_one_deadline_and_stubs_late_items():
+    slow = SlowCompressor(delay_s=10.0)
+    fm = _manager(slow, compress_workers=len(MESSAGES), compress_timeout_s=0.1)
+    t0 = time.perf_counter()
+    msgs, stats = fm.build_context("topic 1", budget_tokens=400)
+    elapsed = time.perf_counter() - t0
+    slow.release.set()
+    fm.close()
+
+    # Sequential per-future waits would take len(MESSAGES) * timeout
+    assert elapsed < 0.5
+    assert stats["compress_timeouts"] == len(MESSAGES)
+    assert stats["compressed_count"] == 0
+    assert stats["stub_count"] == len(MESSAGES)
+    assert all(text.startswith("[ref #") for _, text in msgs)
@@ -0,0 +1,47 @@
+# tests/test_priority_packing.py
+import random
+
+import pytest
+
+from compression import Compressor, HeuristicCompressor
+from embedding import HashingEmbedder
+from focus import FocusConfig, FocusManager
+from token_counter import TokenCounter
+
+_rng = random.Random(7)
+# Plain prose first calibrates the estimator; the later id-heavy messages
+# have far more tokens per byte, so their estimated sizes are too small
+MESSAGES = [
+    ("user" if i % 2 == 0 else "assistant",
+     f"Note {i} on the trip itinerary for city {i % 3}. We walked along the river and "
+     f"talked about dinner plans for a while. The weather stayed mild all afternoon.")
+    for i in range(24)
+] + [
+    ("user" if i % 2 == 0 else "assistant",
+     f"Trip itinerary log {i}: " + " ".join("%08x" % _rng.getrandbits(32) for _ in range(8 + i % 6))
+     + f". Booking refs for city {i % 3}: " + ",".join(str(_rng.getrandbits(20)) for _ in range(6)) + ".")
+    for i in range(24, 60)
+]
+PREAMBLE = "You are a helpful, concise assistant."
+
+class OvershootCompressor(Compressor):
+    """Returns about twice `target_tokens` words, as LLM compressors sometimes do."""
+    def compress(self, text: str, target_tokens: int, hint=None) -> str:
+        return " ".join(text.split()[:2 * target_tokens])
+
+@pytest.mark.parametrize("overshoot", [False, True])
+@pytest.mark.parametrize("estimate_tokens", [False, True])
+@pytest.mark.parametrize("budget", [0, 7, 40, 150, 600, 5000])
+def test_real_tokens_stay_within_budget(overshoot, estimate_tokens, budget):
+    tc = TokenCounter("gpt-4o-mini")
+    config = FocusConfig(packing="priority", high_threshold=0.1, mid_threshold=0.02,
+                         estimate_tokens=estimate_tokens)
+    compressor = OvershootCompressor(tc) if overshoot else HeuristicCompressor(tc)
+    fm = FocusManager(HashingEmbedder(dim=64, stable=True), tc, compressor, config)
+    fm.add_messages(MESSAGES)
+    for query in ("trip itinerary log", "dinner plans", MESSAGES[47][1]):
+        msgs, stats = fm.build_context(query, budget, system_preamble=PREAMBLE)
+        real = sum(TokenCounter("gpt-4o-mini").count(text) for _, text in msgs)
+        assert real <= budget
+        assert stats["used"] <= real
+    fm.close()
@@ -0,0 +1,21 @@
+# tests/test_token_counter.py
+import os
+
+import pytest
+
+pytest.importorskip("tiktoken")
+
+import token_counter
+
+def test_offline_missing_encoding_fails_fast(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        token_counter._load_encoding("o200k_base", str(tmp_path), offline=True)
+
+def test_pinned_file_is_verified_without_touching_env(tmp_path, monkeypatch):
+    monkeypatch.delenv("TIKTOKEN_CACHE_DIR", raising=False)
+    monkeypatch.setenv("DATA_GYM_CACHE_DIR", "")  # keep tiktoken's own cache out of the way
+    (tmp_path / "cl100k_base.tiktoken").write_bytes(b"YQ== 0\nYg== 1\n")
+    with pytest.raises(ValueError, match="Hash mismatch"):
+        token_counter._load_encoding("cl100k_base", str(tmp_path), offline=True)
+    assert "TIKTOKEN_CACHE_DIR" not in os.environ
+    assert (tmp_path / "cl100k_base.tiktoken").exists()
@@ -1,36 +1,425 @@
 # token_counter.py
 from __future__ import annotations
 
+import hashlib
+import math
+from array import array
+from bisect import bisect_left
+import os
+import threading
+import time
+import types
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
 try:
     import tiktoken  # type: ignore
 except Exception:  # pragma: no cover
     tiktoken = None
 
+# Process-wide encodings, loaded once on first use and shared by every counter.
+# Failed loads are remembered per (name, cache_dir, offline) source for
+# _ENCODING_RETRY_S seconds, so an offline machine does not keep retrying the
+# network while another source (or a later attempt) can still succeed.
+_ENCODINGS: Dict[str, object] = {}
+_ENCODING_ERRORS: Dict[Tuple[str, Optional[str], bool], Tuple[str, float]] = {}
+_ENCODING_LOAD_S: Dict[str, float] = {}
+_ENCODING_LOCK = threading.Lock()
+_ENCODING_RETRY_S = 300.0
+
+def encoding_name(model_name: str) -> str:
+    """tiktoken encoding name for a model (cl100k_base when unknown); no I/O."""
+    if tiktoken is not None:
+        try:
+            return tiktoken.encoding_name_for_model(model_name)
+        except Exception:
+            pass
+    return "cl100k_base"
+
+def get_encoding(name: str, cache_dir: Optional[str] = None, offline: Optional[bool] = None):
+    """
+    Shared tiktoken Encoding `name`, or None when it cannot be loaded.
+    cache_dir (default: $TIKTOKEN_CACHE_DIR) is a pinned directory holding
+    either tiktoken's own cache files or plain `<name>.tiktoken` BPE files.
+    offline (default: $AFM_TOKENIZER_OFFLINE) never touches the network:
+    an encoding missing from cache_dir fails immediately.
+    """
+    enc = _ENCODINGS.get(name)
+    if enc is not None:
+        return enc
+    source = _encoding_source(name, cache_dir, offline)
+    if _recently_failed(source):
+        return None
+    with _ENCODING_LOCK:
+        enc = _ENCODINGS.get(name)
+        if enc is not None or _recently_failed(source):
+            return enc
+        t0 = time.perf_counter()
+        try:
+            enc = _load_encoding(*source)
+            _ENCODINGS[name] = enc
+        except Exception as e:
+            _ENCODING_ERRORS[source] = (f"{type(e).__name__}: {e}", time.monotonic())
+            enc = None
+        _ENCODING_LOAD_S[name] = time.perf_counter() - t0
+    return enc
+
+def encoding_stats() -> Dict[str, Dict[str, object]]:
+    """Per-encoding load time in seconds and last error (if no load succeeded)."""
+    errors = {source[0]: err for source, (err, _) in _ENCODING_ERRORS.items()}
+    return {
+        name: {"load_s": secs, "loaded": name in _ENCODINGS,
+               "error": None if name in _ENCODINGS else errors.get(name)}
+        for name, secs in _ENCODING_LOAD_S.items()
+    }
+
+def _encoding_source(name: str, cache_dir: Optional[str], offline: Optional[bool]):
+    """(name, cache_dir, offline) with the environment defaults applied."""
+    cache_dir = cache_dir or os.environ.get("TIKTOKEN_CACHE_DIR") or None
+    if offline is None:
+        offline = os.environ.get("AFM_TOKENIZER_OFFLINE", "") not in ("", "0")
+    return name, cache_dir, bool(offline)
+
+def _recently_failed(source) -> bool:
+    err = _ENCODING_ERRORS.get(source)
+    return err is not None and time.monotonic() - err[1] < _ENCODING_RETRY_S
+
+def _load_encoding(name: str, cache_dir: Optional[str], offline: bool):
+    if tiktoken is None:
+        raise RuntimeError("tiktoken is not installed")
+    if not cache_dir:
+        if offline:
+            raise RuntimeError("offline mode needs a tokenizer cache_dir")
+        return tiktoken.get_encoding(name)
+
+    # Run tiktoken's own constructor (pattern, special tokens, expected
+    # hash) with BPE ranks read from cache_dir. Its globals are copied rather
+    # than patched, and the process environment is left alone.
+    from tiktoken.load import load_tiktoken_bpe
+    from tiktoken_ext.openai_public import ENCODING_CONSTRUCTORS
+
+    constructor = ENCODING_CONSTRUCTORS.get(name)
+    if constructor is None:
+        raise ValueError(f"Unknown encoding {name!r}")
+
+    def load_pinned(url: str, expected_hash: Optional[str] = None):
+        return load_tiktoken_bpe(_bpe_file(url, cache_dir, offline, expected_hash), expected_hash)
+
+    isolated = types.FunctionType(constructor.__code__,
+                                  {**constructor.__globals__, "load_tiktoken_bpe": load_pinned},
+                                  constructor.__name__, constructor.__defaults__, constructor.__closure__)
+    return tiktoken.Encoding(**isolated())
+
+def _bpe_file(url: str, cache_dir: str, offline: bool, expected_hash: Optional[str]) -> str:
+    """
+    Local BPE file for `url` in cache_dir: a pinned `<name>.tiktoken`, else
+    tiktoken's sha1(url) cache file, else (online only) a verified download
+    saved as the pinned file. A file failing the hash check raises.
+    """
+    pinned = os.path.join(cache_dir, os.path.basename(url))
+    cached = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest())
+    from tiktoken.load import check_hash, read_file
+
+    for path in (pinned, cached):
+        if os.path.exists(path):
+            # Checked here too: tiktoken skips its own check when caching is off
+            if expected_hash and not check_hash(read_file(path), expected_hash):
+                raise ValueError(f"Hash mismatch for {path}")
+            return path
+    if offline:
+        raise FileNotFoundError(f"{os.path.basename(url)} is not in tokenizer cache {cache_dir}")
+    data = read_file(url)
+    if expected_hash and not check_hash(data, expected_hash):
+        raise ValueError(f"Hash mismatch for {url}")
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{pinned}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, pinned)
+    return pinned
+
+_EST_MIN_BYTES = 64       # shorter texts are always counted exactly
+_EST_MIN_SAMPLES = 16     # exact counts needed before estimating
+_EST_SAMPLE_EVERY = 32    # every Nth estimate is counted exactly to keep calibrating
+_EST_SLACK = 0.10         # widening of the observed ratio range for the bounds
+
 class TokenCounter:
     """
     Token length estimator with optional tiktoken backend.
     Defaults to 'gpt-4o-mini' encoding, falls back to cl100k_base,
     then to naive whitespace count.
+    Counts are memoized in a bounded LRU of `cache_size` entries: strings up
+    to `hash_min_chars` characters are their own key, longer ones are keyed
+    by a digest so the cache does not pin large texts. cache_size=0 disables it.
+    estimate() predicts counts from UTF-8 byte length, using the tokens/byte
+    ratios seen in this session's exact counts, and returns bounds.
+    The encoding comes from the process-wide registry (see get_encoding) and
+    is loaded on first use, so constructing a counter does no I/O.
     """
-    def __init__(self, model_name: str = "gpt-4o-mini"):
+    def __init__(
+        self,
+        model_name: str = "gpt-4o-mini",
+        cache_size: int = 16384,
+        hash_min_chars: int = 256,
+        cache_dir: Optional[str] = None,
+        offline: Optional[bool] = None,
+    ):
         self.model_name = model_name
-        self._enc = None
-        if tiktoken is not None:
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.cache_size = cache_size
+        self.hash_min_chars = hash_min_chars
+        self.hits = self.misses = 0
+        self._cache: "OrderedDict[object, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Calibration: tokens/byte ratios of exactly counted texts
+        self.est_calls = self.est_exact = 0
+        self._ratio_n = 0
+        self._ratio_sum = 0.0
+        self._ratio_min = math.inf
+        self._ratio_max = 0.0
+        self._encoding = None
+        self._encoding_name = ""
+        self._encoding_resolved = False
+
+    @property
+    def _enc(self):
+        if not self._encoding_resolved:
+            name = encoding_name(self.model_name)
+            enc = get_encoding(name, self.cache_dir, self.offline)
+            if enc is None and name != "cl100k_base":
+                name = "cl100k_base"
+                enc = get_encoding(name, self.cache_dir, self.offline)
+            self._encoding, self._encoding_name, self._encoding_resolved = enc, name, True
+        return self._encoding
+
+    @property
+    def backend(self) -> str:
+        """Encoding name in use, or "whitespace" for the fallback proxy."""
+        enc = self._enc
+        return enc.name if enc is not None else "whitespace"
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.cache_size <= 0:
+            n = self._count(text)
+            with self._lock:
+                self._observe(text, n)
+            return n
+        key = text if len(text) < self.hash_min_chars else _digest(text)
+        with self._lock:
+            n = self._cache.get(key)
+            if n is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return n
+            self.misses += 1
+        n = self._count(text)
+        with self._lock:
+            self._observe(text, n)
+            self._cache[key] = n
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return n
+
+    def count_many(self, texts: Sequence[str], num_threads: Optional[int] = None) -> List[int]:
+        """
+        Token counts for `texts`, in input order.
+        Uncached texts are encoded in one tiktoken encode_ordinary_batch call
+        on `num_threads` threads (default: CPU count; whitespace proxy
+        without tiktoken). Results match count().
+        """
+        out = [0] * len(texts)
+        todo: Dict[object, List[int]] = {}
+        with self._lock:
+            for i, text in enumerate(texts):
+                if not text:
+                    continue
+                key = text if self.cache_size <= 0 or len(text) < self.hash_min_chars else _digest(text)
+                n = self._cache.get(key) if self.cache_size > 0 else None
+                if n is not None:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    out[i] = n
+                else:
+                    todo.setdefault(key, []).append(i)
+            if self.cache_size > 0:
+                self.misses += sum(len(idx) for idx in todo.values())
+        if not todo:
+            return out
+
+        batch = [texts[idx[0]] for idx in todo.values()]
+        counts = None
+        threads = num_threads or os.cpu_count() or 1
+        if self._enc is not None and threads > 1 and len(batch) > 1:
             try:
-                self._enc = tiktoken.encoding_for_model(model_name)
+                counts = [len(t) for t in self._enc.encode_ordinary_batch(batch, num_threads=threads)]
             except Exception:
+                counts = None
+        if counts is None:
+            counts = [self._count(t) for t in batch]
+
+        with self._lock:
+            for (key, idx), n in zip(todo.items(), counts):
+                self._observe(texts[idx[0]], n)
+                for i in idx:
+                    out[i] = n
+                if self.cache_size > 0:
+                    self._cache[key] = n
+            while len(self._cache) > self.cache_size > 0:
+                self._cache.popitem(last=False)
+        return out
+
+    def truncate(self, text: str, max_tokens: int, snap_words: bool = True, ids=None) -> str:
+        """
+        Longest prefix of `text` within `max_tokens` tokens: one encode, a
+        slice of the ids and one decode. With snap_words a cut inside a word
+        backs off to the previous whitespace. Without tiktoken this is the
+        first `max_tokens` whitespace words (as utils.truncate_to_tokens).
+        `ids` may carry precomputed ids of `text`, or of a longer string
+        starting with `text`, to skip the encode.
+        """
+        if not text or max_tokens <= 0:
+            return ""
+        if self._enc is not None:
+            if ids is None:
                 try:
-                    self._enc = tiktoken.get_encoding("cl100k_base")
+                    ids = self._enc.encode_ordinary(text)
                 except Exception:
-                    self._enc = None
+                    ids = None
+            if ids is not None:
+                if len(ids) <= max_tokens:
+                    return text
+                # Drop a trailing partial UTF-8 sequence, keeping an exact prefix
+                out = self.decode(ids[:max_tokens])[: len(text)]
+                if out == text:
+                    return text
+                if snap_words and not out[-1:].isspace() and not text[len(out):len(out) + 1].isspace():
+                    cut = max(out.rfind(" "), out.rfind("\n"), out.rfind("\t"))
+                    if cut > 0:
+                        out = out[:cut]
+                return out.rstrip()
+        return " ".join(text.split()[:max_tokens])
 
-    def count(self, text: str) -> int:
+    def encode(self, text: str) -> Optional[array]:
+        """Token ids of `text` as a compact array('I'), or None without tiktoken. Primes count()."""
+        enc = self._enc
+        if enc is None or not text:
+            return None if enc is None else array("I")
+        try:
+            ids = array("I", enc.encode_ordinary(text))
+        except Exception:
+            return None
+        if self.cache_size > 0:
+            key = text if len(text) < self.hash_min_chars else _digest(text)
+            with self._lock:
+                self._observe(text, len(ids))
+                self._cache[key] = len(ids)
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return ids
+
+    def decode(self, ids) -> str:
+        """Text of `ids`; a trailing partial UTF-8 sequence is dropped."""
+        return self._enc.decode_bytes(list(ids)).decode("utf-8", errors="ignore")
+
+    def sentence_ends(self, text: str, ids) -> array:
+        """
+        Token offset where each utils.split_sentences sentence of `text` ends,
+        so sentence k spans ids[ends[k-1]:ends[k]] (whitespace between
+        sentences goes to the next one).
+        """
+        _, starts = self._enc.decode_with_offsets(list(ids))
+        ends = array("I")
+        begin = 0
+        for pos, ch in enumerate(text):
+            if ch in ".!?\n":
+                if text[begin:pos + 1].strip():
+                    ends.append(bisect_left(starts, pos + 1))
+                begin = pos + 1
+        if text[begin:].strip():
+            ends.append(len(ids))
+        return ends
+
+    def estimate(self, text: str) -> Tuple[int, int, int]:
+        """
+        (estimate, lower, upper) token count for `text` without encoding it.
+        Until `_EST_MIN_SAMPLES` texts of at least `_EST_MIN_BYTES` bytes
+        have been counted exactly (and for short texts, or without
+        tiktoken) this counts exactly and all three are equal. The bounds
+        are calibrated, not guaranteed: they use the extreme observed ratios
+        widened by `_EST_SLACK`, and only the byte-length cap on the upper
+        bound is hard. Every `_EST_SAMPLE_EVERY`-th call is
+        counted exactly to keep calibrating.
+        """
         if not text:
-            return 0
+            return 0, 0, 0
+        nbytes = len(text.encode("utf-8"))
+        with self._lock:
+            self.est_calls += 1
+            calibrated = (self._enc is not None and self._ratio_n >= _EST_MIN_SAMPLES
+                          and nbytes >= _EST_MIN_BYTES and self.est_calls % _EST_SAMPLE_EVERY != 0)
+            if calibrated:
+                mean = self._ratio_sum / self._ratio_n
+                lo, hi = self._ratio_min * (1 - _EST_SLACK), self._ratio_max * (1 + _EST_SLACK)
+            else:
+                self.est_exact += 1
+        if not calibrated:
+            n = self.count(text)
+            return n, n, n
+        return (max(1, round(nbytes * mean)), max(1, int(nbytes * lo)),
+                min(nbytes, math.ceil(nbytes * hi)))
+
+    def estimate_error(self) -> float:
+        """Relative distance of the upper bound above the mean estimate (0 until calibrated)."""
+        with self._lock:
+            if self._ratio_n < _EST_MIN_SAMPLES:
+                return 0.0
+            return self._ratio_max * (1 + _EST_SLACK) * self._ratio_n / self._ratio_sum - 1.0
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "entries": float(len(self._cache)),
+            "hits": float(self.hits),
+            "misses": float(self.misses),
+            "hit_rate": self.hits / total if total else 0.0,
+            "est_calls": float(self.est_calls),
+            "est_exact": float(self.est_exact),
+            "est_samples": float(self._ratio_n),
+            "est_error": self.estimate_error(),
+            "encoding_load_s": _ENCODING_LOAD_S.get(self._encoding_name, 0.0),
+        }
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    # ---- Internals ----
+
+    def _observe(self, text: str, n: int) -> None:
+        """Feeds one exact count into the estimator calibration (caller holds the lock)."""
+        if self._enc is None or len(text) < _EST_MIN_BYTES // 4:
+            return
+        nbytes = len(text.encode("utf-8"))
+        if nbytes < _EST_MIN_BYTES:
+            return
+        r = n / nbytes
+        self._ratio_n += 1
+        self._ratio_sum += r
+        self._ratio_min = min(self._ratio_min, r)
+        self._ratio_max = max(self._ratio_max, r)
+
+    def _count(self, text: str) -> int:
         if self._enc is not None:
             try:
-                return len(self._enc.encode(text))
+                # encode_ordinary: special-token text counts as text, as in count_many
+                return len(self._enc.encode_ordinary(text))
             except Exception:
                 pass
         # Fallback proxy
         return max(1, len(text.split()))
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
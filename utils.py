@@ -2,7 +2,8 @@
 from __future__ import annotations
 
 import math
-from typing import List
+from array import array
+from typing import Iterator, List, Sequence
 
 def simple_tokenize(text: str) -> List[str]:
     """Lowercase + simple split + strip punctuation."""
@@ -14,8 +15,49 @@ def l2_normalize_inplace(v: List[float]) -> None:
     for i in range(len(v)):
         v[i] /= s
 
-def cosine(a: List[float], b: List[float]) -> float:
-    # assumes L2-normalized inputs
+class SparseVector:
+    """
+    Sparse embedding: sorted `indices` with matching `values` (compact arrays)
+    and logical length `dim`. Iterating yields the dense values.
+    """
+    __slots__ = ("indices", "values", "dim")
+
+    def __init__(self, indices: Sequence[int], values: Sequence[float], dim: int):
+        self.indices = array("i", indices)
+        self.values = array("d", values)
+        self.dim = dim
+
+    @classmethod
+    def from_dense(cls, vec: Sequence[float]) -> "SparseVector":
+        nz = [i for i, x in enumerate(vec) if x]
+        return cls(nz, [vec[i] for i in nz], len(vec))
+
+    def to_dense(self) -> List[float]:
+        out = [0.0] * self.dim
+        for i, v in zip(self.indices, self.values):
+            out[i] = v
+        return out
+
+    def __len__(self) -> int:
+        return self.dim
+
+    def __iter__(self) -> Iterator[float]:
+        return iter(self.to_dense())
+
+    def __repr__(self) -> str:
+        return f"SparseVector(nnz={len(self.indices)}, dim={self.dim})"
+
+def cosine(a, b) -> float:
+    # assumes L2-normalized inputs; either side may be a SparseVector
+    if isinstance(a, SparseVector):
+        if isinstance(b, SparseVector):
+            if len(a.indices) > len(b.indices):
+                a, b = b, a
+            lookup = dict(zip(b.indices, b.values))
+            return float(sum(v * lookup.get(i, 0.0) for i, v in zip(a.indices, a.values)))
+        return float(sum(v * b[i] for i, v in zip(a.indices, a.values)))
+    if isinstance(b, SparseVector):
+        return cosine(b, a)
     return float(sum(x * y for x, y in zip(a, b)))
 
 def split_sentences(text: str) -> List[str]: